@@ -1,5 +1,7 @@
 import os
 import asyncio
+import sys
+import time
 
 from config import Config
 from market import Market
@@ -8,10 +10,16 @@ from database import Database
 from cmc import Cmc
 from logger import LoggerFactory
 from indicators import Indicators
-from quart import Quart
+from executor import Executor
+from store import Store
+from broadcast import Broadcast
+from metrics import Metrics
+from response_cache import ResponseCache
+from screener import Screener
+import serialization
+from quart import Quart, Response, g, make_response, request, websocket
 from quart_cors import route_cors
 
-
 ######################################################
 #                       Config                       #
 ######################################################
@@ -41,9 +49,62 @@ logging = LoggerFactory.get_logger("logs/moonloader.log", "main", log_level=logl
 #                        Init                        #
 ######################################################
 
+# Initialize candle store
+database_kind = attributes.get("database", "sqlite")
+if database_kind not in ("sqlite", "postgres"):
+    sys.tracebacklimit = 0
+    sys.exit(f"Unknown database {database_kind} - use sqlite or postgres.")
+# Mandatory for postgres - Store and Database both use the resolved setting
+database_url = attributes.get("database_url") if database_kind == "postgres" else None
+timeframe = attributes.get("timeframe", "1m")
+# Natively subscribed timeframes besides the configured timeframe
+native_timeframes = [
+    item.strip()
+    for item in str(attributes.get("timeframes", timeframe)).split(",")
+    if item.strip() and item.strip() != timeframe
+]
+rollup_timeranges = str(attributes.get("rollup_timeranges", "15min,1h,4h,1d"))
+candle_store = attributes.get("candle_store", "database")
+if candle_store not in ("database", "columnar"):
+    sys.tracebacklimit = 0
+    sys.exit(f"Unknown candle_store {candle_store} - use database or columnar.")
+store = Store(
+    kind=candle_store,
+    path="db/candles",
+    database="postgres" if database_url else "sqlite",
+    timescale=attributes.get("timescale", False),
+    timeranges=[
+        timerange.strip()
+        for timerange in rollup_timeranges.split(",")
+        if timerange.strip()
+    ],
+)
+
 # Initialize database
 database = Database(
-    "moonloader.sqlite", loglevel, attributes.get("housekeeping_interval", 1)
+    "moonloader.sqlite",
+    loglevel,
+    attributes.get("housekeeping_retention", 0),
+    retention=attributes.get("retention", None),
+    housekeeping_chunk_size=attributes.get("housekeeping_chunk_size", 5000),
+    housekeeping_interval=attributes.get("housekeeping_interval", 60),
+    pragmas={
+        "journal_mode": attributes.get("sqlite_journal_mode", "WAL"),
+        "synchronous": attributes.get("sqlite_synchronous", "NORMAL"),
+        "cache_size": attributes.get("sqlite_cache_size", -65536),
+        "mmap_size": attributes.get("sqlite_mmap_size", 268435456),
+        "busy_timeout": attributes.get("sqlite_busy_timeout", 5000),
+    },
+    read_connections=attributes.get("sqlite_read_connections", 2),
+    url=database_url,
+    pool_size=attributes.get("database_pool_size", 10),
+    native_timeframes=native_timeframes,
+)
+
+# Initialize the calculation executor
+executor = Executor(
+    kind=attributes.get("executor", "thread"),
+    workers=attributes.get("executor_workers", 4),
 )
 
 # Initialize Indicators
@@ -51,10 +112,28 @@ indicators = Indicators(
     loglevel=loglevel,
     currency=attributes.get("currency", "USDT"),
     timeframe=attributes.get("timeframe", "1m"),
+    indicator_streams=attributes.get("indicator_streams", 64),
 )
 
+# Initialize Screener
+screener = Screener(loglevel=loglevel, timeframe=attributes.get("timeframe", "1m"))
+
 # Initialize Data
-data = Data(loglevel=loglevel)
+data = Data(
+    loglevel=loglevel,
+    candle_buffer_size=attributes.get("candle_buffer_size", 20000),
+    resample_cache_size=attributes.get("resample_cache_size", 256),
+    rollup_timeranges=rollup_timeranges,
+    rollup_size=attributes.get("rollup_size", 1000),
+    stale_threshold=attributes.get("stale_threshold", 30),
+    native_timeframes=native_timeframes,
+    ohlcv_block_size=attributes.get("ohlcv_block_size", 10000),
+)
+
+# Initialize the response cache
+response_cache = ResponseCache(
+    loglevel=loglevel, size=attributes.get("response_cache_size", 4096)
+)
 
 # Initialize Market module
 market = Market(
@@ -67,11 +146,26 @@ market = Market(
     loglevel=loglevel,
     timeframe=attributes.get("timeframe", "1m"),
     history_data=attributes.get("history_data", None),
+    write_batch_size=attributes.get("write_batch_size", 500),
+    write_flush_interval=attributes.get("write_flush_interval", 1),
+    backfill_concurrency=attributes.get("backfill_concurrency", 4),
+    timeframes=native_timeframes,
+    shard_size=attributes.get("websocket_shard_size", 200),
+)
+
+# Initialize websocket broadcast
+broadcast = Broadcast(
+    loglevel=loglevel,
+    indicators=indicators,
+    buffer_size=attributes.get("websocket_buffer_size", 100),
 )
 
 # Initialize Global module
 cmc = Cmc(cmc_api_key=attributes.get("cmc_api_key"), loglevel=loglevel)
 
+# Initialize metrics
+metrics = Metrics()
+
 # Initialize app
 app = Quart(__name__)
 
@@ -81,6 +175,31 @@ app = Quart(__name__)
 ######################################################
 
 
+@app.before_request
+async def start_timer():
+    g.start_time = time.perf_counter()
+    Metrics.endpoint.set(request.endpoint)
+
+
+@app.after_request
+async def record_latency(response):
+    if request.endpoint is not None and "start_time" in g:
+        metrics.observe(
+            "moonloader_request_seconds",
+            time.perf_counter() - g.start_time,
+            endpoint=request.endpoint,
+            status=response.status_code,
+        )
+    Metrics.endpoint.set(None)
+
+    return response
+
+
+def full_recompute():
+    """Use ?full=true to recompute an indicator over the whole history with talib."""
+    return str(request.args.get("full", "false")).lower() == "true"
+
+
 @app.route("/api/v1/symbol/add/<symbol>", methods=["GET"])
 async def add_symbol(symbol):
     symbol = symbol.split(attributes.get("currency", "USDT"))[0]
@@ -107,26 +226,57 @@ async def remove_symbol(symbol):
     return response
 
 
+@app.route("/api/v1/symbol/backfill", methods=["GET"])
+async def backfill_status():
+    response = {"result": market.backfill.status()}
+
+    return response
+
+
+@app.route("/api/v1/symbol/backfill/<symbol>", methods=["GET"])
+async def backfill_symbol_status(symbol):
+    symbol = symbol.split(attributes.get("currency", "USDT"))[0]
+    symbol = f"{symbol}/{attributes.get('currency', 'USDT')}"
+    status = market.backfill.status(symbol)
+    if not status:
+        response = {"result": ""}
+    else:
+        response = {"result": status}
+
+    return response
+
+
+@app.route("/api/v1/symbol/shards", methods=["GET"])
+async def shards():
+    response = market.get_shard_stats()
+
+    return response
+
+
 @app.route("/api/v1/symbol/list", methods=["GET"])
 async def status_symbol():
     symbol_list = await market.status_symbols()
     if not symbol_list:
         response = {"result": ""}
     else:
-        response = '{"result": ' + str(symbol_list) + "}"
+        response = {"result": symbol_list}
 
     return response
 
 
 @app.route("/api/v1/indicators/rsi/<symbol>/<timerange>/<length>", methods=["GET"])
+@response_cache.cached()
 async def rsi(symbol, timerange, length):
     df = None
-    response = await indicators.calculate_rsi(df, symbol, timerange, int(length))
+    response = await indicators.calculate_rsi(
+        df, symbol, timerange, int(length), full=full_recompute()
+    )
 
     return response
 
 
 @app.route("/api/v1/indicators/btc_pulse/<timerange>", methods=["GET"])
+@response_cache.cached(pair=f"BTC{attributes.get('currency', 'USDT')}")
 async def btc_pulse(timerange):
     response = await indicators.calculate_btc_pulse(timerange)
 
@@ -134,6 +284,7 @@ async def btc_pulse(timerange):
 
 
 @app.route("/api/v1/indicators/ema_cross/<symbol>/<timerange>", methods=["GET"])
+@response_cache.cached()
 async def ema_cross(symbol, timerange):
     df = None
     response = await indicators.calculate_ema_cross(df, symbol, timerange)
@@ -142,9 +293,12 @@ async def ema_cross(symbol, timerange):
 
 
 @app.route("/api/v1/indicators/ema/<symbol>/<timerange>/<length>", methods=["GET"])
+@response_cache.cached()
 async def ema(symbol, timerange, length):
     df = None
-    response = await indicators.calculate_ema(df, symbol, timerange, int(length))
+    response = await indicators.calculate_ema(
+        df, symbol, timerange, int(length), full=full_recompute()
+    )
 
     return response
 
@@ -152,9 +306,12 @@ async def ema(symbol, timerange, length):
 @app.route(
     "/api/v1/indicators/ema_slope/<symbol>/<timerange>/<length>", methods=["GET"]
 )
+@response_cache.cached()
 async def ema_slope(symbol, timerange, length):
     df = None
-    response = await indicators.calculate_ema_slope(df, symbol, timerange, int(length))
+    response = await indicators.calculate_ema_slope(
+        df, symbol, timerange, int(length), full=full_recompute()
+    )
 
     return response
 
@@ -162,6 +319,7 @@ async def ema_slope(symbol, timerange, length):
 @app.route(
     "/api/v1/indicators/ema_distance/<symbol>/<timerange>/<length>", methods=["GET"]
 )
+@response_cache.cached()
 async def ema_distance(symbol, timerange, length):
     df = None
     response = await indicators.calculate_ema_distance(
@@ -172,15 +330,19 @@ async def ema_distance(symbol, timerange, length):
 
 
 @app.route("/api/v1/indicators/sma/<symbol>/<timerange>", methods=["GET"])
+@response_cache.cached()
 async def sma(symbol, timerange):
-    response = await indicators.calculate_sma(symbol, timerange)
+    response = await indicators.calculate_sma(symbol, timerange, full=full_recompute())
 
     return response
 
 
 @app.route("/api/v1/indicators/sma_slope/<symbol>/<timerange>", methods=["GET"])
+@response_cache.cached()
 async def sma_slope(symbol, timerange):
-    response = await indicators.categorize_sma_slope(symbol, timerange)
+    response = await indicators.categorize_sma_slope(
+        symbol, timerange, full=full_recompute()
+    )
 
     return response
 
@@ -188,6 +350,7 @@ async def sma_slope(symbol, timerange):
 @app.route(
     "/api/v1/indicators/rsi_slope/<symbol>/<timerange>/<length>", methods=["GET"]
 )
+@response_cache.cached()
 async def rsi_slope(symbol, timerange, length):
     df = None
     response = await indicators.calculate_rsi_slope(df, symbol, timerange, int(length))
@@ -198,12 +361,68 @@ async def rsi_slope(symbol, timerange, length):
 @app.route(
     "/api/v1/indicators/support/<symbol>/<timerange>/<numlevels>", methods=["GET"]
 )
+@response_cache.cached()
 async def support_level(symbol, timerange, numlevels):
     response = await indicators.detect_support_levels(symbol, timerange, int(numlevels))
 
     return response
 
 
+@app.route("/api/v1/indicators/levels/<symbol>/<timerange>", methods=["GET"])
+@response_cache.cached()
+async def levels(symbol, timerange):
+    """Optional ?num_levels=5&lookback=5&tolerance=0.005&merge_tolerance=0.025"""
+    response = await indicators.calculate_levels(
+        symbol,
+        timerange,
+        num_levels=request.args.get("num_levels", 5, type=int),
+        lookback=request.args.get("lookback", 5, type=int),
+        tolerance=request.args.get("tolerance", 0.005, type=float),
+        merge_tolerance=request.args.get("merge_tolerance", 0.025, type=float),
+    )
+
+    return response
+
+
+@app.route("/api/v1/indicators/batch", methods=["POST"])
+async def batch():
+    requests = await request.get_json(silent=True)
+    if isinstance(requests, dict):
+        requests = requests.get("requests")
+    if not isinstance(requests, list):
+        return {"result": ""}, 400
+
+    response = await indicators.calculate_batch(requests)
+
+    return response
+
+
+@app.route("/api/v1/screener/<timerange>", methods=["GET"])
+async def screen(timerange):
+    """Filter like ?filter=rsi<30 and ema_distance<2&sort=-price_action&limit=20"""
+    try:
+        response = await screener.screen(
+            timerange,
+            filter=request.args.get("filter"),
+            sort=request.args.get("sort"),
+            limit=request.args.get("limit", type=int),
+            rsi_length=request.args.get("rsi_length", 14, type=int),
+            ema_length=request.args.get("ema_length", 50, type=int),
+            price_action_length=request.args.get("price_action_length", 24, type=int),
+        )
+    except ValueError as e:
+        return {"result": "", "error": str(e)}, 400
+
+    return response
+
+
+@app.route("/api/v1/data/screener", methods=["GET"])
+async def screener_stats():
+    response = screener.get_stats()
+
+    return response
+
+
 @app.route("/api/v1/indicators/marketstate/stablecoin_dominance", methods=["GET"])
 async def stablecoin_dominance():
     response = await indicators.get_stablecoin_dominance()
@@ -223,27 +442,172 @@ async def buy_signal(symbol, timerange):
     methods=["GET"],
 )
 @route_cors(allow_origin="*")
+@response_cache.cached()
 async def get_ohlcv(symbol, timerange, timestamp_start, offset):
-    response = await data.get_ohlcv_for_pair(symbol, timerange, timestamp_start, offset)
+    """Format by ?format=json|columns|msgpack|arrow or the Accept header.
+
+    ?end= (in ms) ends the range, ?limit= returns a page of at most limit
+    candles with the timestamp_start of the next page in the X-Next-Cursor
+    header and ?stream=true writes the candles chunk by chunk.
+    """
+    try:
+        format = serialization.negotiate(
+            request.args.get("format"), request.accept_mimetypes
+        )
+    except ValueError as e:
+        return {"result": "", "error": str(e)}, 406
+
+    end = request.args.get("end", None)
+    limit = request.args.get("limit", None)
+    try:
+        timestamp_start = int(float(timestamp_start))
+        offset = int(offset)
+        end = int(end) if end else None
+        limit = int(limit) if limit else None
+        if limit is not None and limit <= 0:
+            raise ValueError("limit has to be positive")
+        if request.args.get("stream", "false").lower() == "true":
+            body = serialization.stream(
+                data.iter_ohlcv_columns(
+                    symbol, timerange, timestamp_start, offset, end
+                ),
+                format,
+            )
+            return Response(body, mimetype=serialization.formats[format])
+    except (ValueError, OverflowError) as e:
+        return {"result": "", "error": str(e)}, 400
+
+    cursor = None
+    if limit:
+        columns, cursor = await data.get_ohlcv_page(
+            symbol, timerange, timestamp_start, offset, limit, end
+        )
+    else:
+        columns = await data.get_ohlcv_columns(
+            symbol, timerange, timestamp_start, offset, end
+        )
+    if columns is None and format == "json":
+        return {}
+
+    response = await make_response(
+        serialization.encode(
+            columns or {name: [] for name in ("open", "high", "close", "low", "time")},
+            format,
+        )
+    )
+    response.mimetype = serialization.formats[format]
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = str(cursor)
+
+    return response
+
+
+@app.route("/api/v1/data/resample_cache", methods=["GET"])
+async def resample_cache():
+    response = data.get_resample_cache_stats()
+
+    return response
+
+
+@app.route("/api/v1/data/response_cache", methods=["GET"])
+async def response_cache_stats():
+    response = response_cache.get_stats()
+
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    response = Response(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+    return response
+
+
+@app.route("/api/v1/health", methods=["GET"])
+async def health():
+    response = data.get_health()
+    if response["status"] != "ok":
+        return response, 503
+
+    return response
+
+
+@app.route("/api/v1/data/rollups", methods=["GET"])
+async def rollups():
+    response = data.get_rollup_stats()
+
+    return response
+
+
+@app.route("/api/v1/data/housekeeping", methods=["GET"])
+async def housekeeping():
+    response = database.get_housekeeping_stats()
 
     return response
 
 
+@app.route("/api/v1/data/writer", methods=["GET"])
+async def writer_stats():
+    response = market.writer.get_stats()
+
+    return response
+
+
+@app.route("/api/v1/data/executor", methods=["GET"])
+async def executor_stats():
+    response = executor.get_stats()
+
+    return response
+
+
+@app.websocket("/api/v1/ws")
+async def ws():
+    """Subscribe with {"action": "subscribe", "symbol": "BTCUSDT", "timerange": "15min", "indicator": "rsi", "length": 14}"""
+    client = broadcast.connect()
+
+    async def sender():
+        while True:
+            message = await client.get()
+            await websocket.send_json(message)
+
+    task = asyncio.ensure_future(sender())
+    try:
+        while True:
+            message = await websocket.receive_json()
+            response = await broadcast.handle(client, message)
+            await client.put(response)
+    finally:
+        task.cancel()
+        broadcast.disconnect(client)
+
+
 @app.before_serving
 async def startup():
     await database.init()
+    await market.registry.load()
+    await data.load_candles()
 
     app.add_background_task(database.cleanup)
+    app.add_background_task(market.writer.run)
+    app.add_background_task(market.registry.run)
     app.add_background_task(market.watch_tickers)
+    app.add_background_task(market.resume_backfill)
+    app.add_background_task(broadcast.run)
     app.add_background_task(cmc.get_global_data)
     app.add_background_task(data.data_sanity_check)
+    app.add_background_task(metrics.watch_event_loop)
 
 
 @app.after_serving
 async def shutdown():
+    metrics.shutdown()
+    await broadcast.shutdown()
     await data.shutdown()
     await cmc.shutdown()
     await market.shutdown()
+    executor.shutdown()
     await database.shutdown()
 
 
@@ -0,0 +1,271 @@
+import asyncio
+import ccxt as ccxt
+import contextvars
+
+from datetime import datetime, UTC
+from logger import LoggerFactory
+from metrics import Metrics
+from models import Tickers
+from store import Store
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
+
+
+class Backfill:
+    """Fetches historical candles of symbols as background jobs.
+
+    The missing range of a symbol (from the last stored candle or the
+    configured history date until the running candle) is split into windows
+    of one page each. The windows are fetched concurrently - bounded by the
+    concurrency setting and throttled by the ccxt rate limiter - and every
+    page is written to the database as soon as it arrives. The unfetched
+    rest of failed windows is retried a few times and otherwise kept in the
+    job, so the next job of the symbol fetches it first. Once done, the
+    candles closed meanwhile are fetched up to the first candle of the
+    websocket.
+    """
+
+    page_limit = 1000
+    retries = 3
+    retry_delay = 30
+
+    def __init__(self, loglevel, exchange, timeframe, history_data, data, concurrency):
+        self.exchange = exchange
+        self.timeframe = timeframe
+        self.history_data = history_data
+        self.data = data
+        self.store = Store()
+
+        # Class variables
+        Backfill.semaphore = asyncio.Semaphore(int(concurrency))
+        Backfill.jobs = {}
+        Backfill.tasks = {}
+        # Timestamp of the first candle received by the websocket per pair
+        Backfill.live = {}
+        self.data.add_candle_listener(self.__live)
+        Backfill.logging = LoggerFactory.get_logger(
+            "logs/backfill.log", "backfill", log_level=loglevel
+        )
+        Metrics().add_collector("backfill", self.__collect)
+        Backfill.logging.info("Initialized")
+
+    def __collect(self, metrics):
+        for symbol, job in Backfill.jobs.items():
+            pair = symbol.replace("/", "")
+            metrics.set(
+                "moonloader_backfill_progress_percent", job["progress"], symbol=pair
+            )
+            metrics.set("moonloader_backfill_candles", job["candles"], symbol=pair)
+
+    def __live(self, pair, candle):
+        # Resets (None) don't change where the websocket started
+        if candle is not None:
+            Backfill.live.setdefault(pair, int(candle[0]))
+
+    def start(self, symbol) -> dict:
+        """Start a backfill job for the symbol (format BTC/USDT) unless one is running."""
+        job = Backfill.jobs.get(symbol)
+        if job is not None and job["status"] in ("queued", "running"):
+            return job
+
+        job = Backfill.jobs[symbol] = {
+            "symbol": symbol,
+            "status": "queued",
+            "windows": 0,
+            "windows_done": 0,
+            "windows_failed": 0,
+            # Unfetched [since, until] ranges of the failed windows
+            "failed_windows": job["failed_windows"] if job is not None else [],
+            "candles": 0,
+            "progress": 0.0,
+            "started": datetime.now(UTC).isoformat(),
+            "finished": None,
+            "error": None,
+        }
+        # A fresh context, so the job isn't attributed to the request starting it
+        Backfill.tasks[symbol] = asyncio.create_task(
+            self.__run(symbol, job), context=contextvars.Context()
+        )
+
+        return job
+
+    def status(self, symbol=None):
+        if symbol is not None:
+            return Backfill.jobs.get(symbol)
+        return list(Backfill.jobs.values())
+
+    async def __get_start_timestamp(self, pair, timeframe_ms):
+        last_timestamp = await self.store.last_timestamp(pair)
+        if last_timestamp is not None:
+            # Resume after the last stored candle
+            return last_timestamp + timeframe_ms
+
+        return self.exchange.parse8601(self.history_data)
+
+    @retry(
+        retry=retry_if_exception_type(ccxt.NetworkError),
+        wait=wait_fixed(5),
+        stop=stop_after_attempt(5),
+        reraise=True,
+    )
+    async def __fetch_page(self, symbol, since):
+        return await self.exchange.fetch_ohlcv(
+            symbol, self.timeframe, since=since, limit=Backfill.page_limit
+        )
+
+    async def __write(self, pair, candles):
+        await self.store.write(
+            [
+                Tickers(
+                    timestamp=candle[0],
+                    symbol=pair,
+                    open=candle[1],
+                    high=candle[2],
+                    low=candle[3],
+                    close=candle[4],
+                    volume=candle[5],
+                )
+                for candle in candles
+            ]
+        )
+
+    async def __fetch_window(self, job, symbol, pair, window, timeframe_ms):
+        """Fetch the [since, until] window - since moves along with the written pages."""
+        async with Backfill.semaphore:
+            while window[0] < window[1]:
+                since, until = window
+                # The websocket stores the candles from its first one on
+                until = min(until, Backfill.live.get(pair, until))
+                ohlcv = await self.__fetch_page(symbol, since)
+                candles = [candle for candle in ohlcv if since <= candle[0] < until]
+                if candles:
+                    await self.__write(pair, candles)
+                    job["candles"] += len(candles)
+                if not candles or ohlcv[-1][0] + timeframe_ms >= until:
+                    break
+                # The exchange returned less than a window - page through it
+                window[0] = ohlcv[-1][0] + timeframe_ms
+
+        job["windows_done"] += 1
+        job["progress"] = round(job["windows_done"] / job["windows"] * 100, 2)
+
+    async def __fetch_windows(self, job, symbol, pair, windows, timeframe_ms) -> list:
+        """Fetch the windows concurrently, retrying the failed ones - returns those still failing."""
+        for attempt in range(Backfill.retries + 1):
+            if attempt:
+                Backfill.logging.info(
+                    f"Retrying {len(windows)} failed windows of {symbol} in {Backfill.retry_delay}s"
+                )
+                await asyncio.sleep(Backfill.retry_delay)
+            results = await asyncio.gather(
+                *[
+                    self.__fetch_window(job, symbol, pair, window, timeframe_ms)
+                    for window in windows
+                ],
+                return_exceptions=True,
+            )
+            windows = [
+                window
+                for window, result in zip(windows, results)
+                if isinstance(result, Exception)
+            ]
+            if not windows:
+                break
+            job["error"] = str(
+                next(result for result in results if isinstance(result, Exception))
+            )
+
+        return windows
+
+    def __closed_until(self, timeframe_ms):
+        """Start of the running candle - it gets stored by the websocket once closed."""
+        now = self.exchange.milliseconds()
+        return now - now % timeframe_ms
+
+    async def __run(self, symbol, job):
+        symbol_name, market = symbol.split("/")
+        pair = symbol_name + market
+        try:
+            timeframe_ms = self.exchange.parse_timeframe(self.timeframe) * 1000
+            start = await self.__get_start_timestamp(pair, timeframe_ms)
+            end = self.__closed_until(timeframe_ms)
+            window = timeframe_ms * Backfill.page_limit
+            # The gaps left by the last job go first
+            windows = job["failed_windows"] + [
+                [since, min(since + window, end)] for since in range(start, end, window)
+            ]
+
+            job["status"] = "running"
+            job["windows"] = len(windows)
+            Backfill.logging.info(
+                f"Backfilling {symbol} from {start} to {end} in {len(windows)} windows"
+            )
+            failed = await self.__fetch_windows(
+                job, symbol, pair, windows, timeframe_ms
+            )
+
+            # Candles which closed during the backfill, up to the first of the websocket
+            until = self.__closed_until(timeframe_ms)
+            if until > end:
+                job["windows"] += 1
+                failed += await self.__fetch_windows(
+                    job, symbol, pair, [[end, until]], timeframe_ms
+                )
+
+            # Reload the in-memory candles with the fetched history
+            await self.data.load_candles([symbol])
+
+            job["failed_windows"] = failed
+            job["windows_failed"] = len(failed)
+            if failed:
+                raise RuntimeError(
+                    f"{len(failed)} windows failed, they are fetched by the next backfill. Cause: {job['error']}"
+                )
+
+            job["status"] = "done"
+            job["progress"] = 100.0
+            Backfill.logging.info(f"Backfilled {job['candles']} candles for {symbol}")
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            Backfill.logging.info(f"Backfill of {symbol} cancelled")
+            raise
+        except ccxt.NetworkError as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+            Backfill.logging.error(
+                f"Error fetching historical data from Exchange due to a network error: {e}"
+            )
+        except ccxt.ExchangeError as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+            Backfill.logging.error(
+                f"Error fetching historical data from Exchange due to an exchange error: {e}"
+            )
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+            Backfill.logging.error(
+                f"Error fetching historical data from Exchange. Cause: {e}"
+            )
+        finally:
+            job["finished"] = datetime.now(UTC).isoformat()
+            Backfill.tasks.pop(symbol, None)
+
+    async def cancel(self, symbol) -> bool:
+        """Cancel the job of the symbol and wait until it stopped writing."""
+        task = Backfill.tasks.get(symbol)
+        Backfill.jobs.pop(symbol, None)
+        Backfill.live.pop(symbol.replace("/", ""), None)
+        if task is None:
+            return False
+
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        return True
+
+    async def shutdown(self):
+        for task in list(Backfill.tasks.values()):
+            task.cancel()
@@ -0,0 +1,84 @@
+import asyncio
+import ccxt as ccxt
+import time
+
+from benchmark.generator import OhlcvGenerator
+
+
+class FakeExchange:
+    """Offline stand-in for a ccxt.pro exchange.
+
+    Implements the parts moonloader uses: watch_ohlcv_for_symbols streams
+    one new candle per symbol and call, fetch_ohlcv pages through the
+    synthetic history. Both are served by the OhlcvGenerator.
+    """
+
+    # Set by the benchmark before the exchange gets created
+    seed = 42
+    # Number of watch_ohlcv_for_symbols calls until the stream runs dry
+    watch_rounds = 1000
+    # Simulated network latency per call in seconds
+    latency = 0
+
+    parse8601 = staticmethod(ccxt.Exchange.parse8601)
+    parse_timeframe = staticmethod(ccxt.Exchange.parse_timeframe)
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.reset()
+
+    def reset(self):
+        self.generators = {}
+        self.round = 0
+        self.watch_start = None
+        self.calls = {"watch_ohlcv_for_symbols": 0, "fetch_ohlcv": 0}
+        self.exhausted = asyncio.Event()
+
+    def milliseconds(self):
+        return int(time.time() * 1000)
+
+    def __generator(self, timeframe):
+        if timeframe not in self.generators:
+            self.generators[timeframe] = OhlcvGenerator(timeframe, FakeExchange.seed)
+        return self.generators[timeframe]
+
+    async def watch_ohlcv_for_symbols(self, symbols_and_timeframes, since=None):
+        self.calls["watch_ohlcv_for_symbols"] += 1
+        if self.round >= FakeExchange.watch_rounds:
+            self.exhausted.set()
+            # Like a quiet websocket - wait until the benchmark stops the watcher
+            await asyncio.sleep(3600)
+            return {}
+
+        await asyncio.sleep(FakeExchange.latency)
+        result = {}
+        for symbol, timeframe in symbols_and_timeframes:
+            generator = self.__generator(timeframe)
+            if self.watch_start is None:
+                now = self.milliseconds()
+                self.watch_start = now - now % generator.timeframe_ms
+            since = self.watch_start + self.round * generator.timeframe_ms
+            result.setdefault(symbol, {})[timeframe] = generator.candles(
+                symbol, since, 1
+            )
+        self.round += 1
+
+        return result
+
+    async def fetch_ohlcv(self, symbol, timeframe="1m", since=None, limit=None):
+        self.calls["fetch_ohlcv"] += 1
+        await asyncio.sleep(FakeExchange.latency)
+        generator = self.__generator(timeframe)
+        limit = limit or 500
+        now = self.milliseconds()
+        if since is None:
+            since = now - limit * generator.timeframe_ms
+        # Only closed and running candles - nothing from the future
+        available = (now - since) // generator.timeframe_ms + 1
+        if available <= 0:
+            return []
+
+        return generator.candles(symbol, since, int(min(limit, available)))
+
+    async def close(self):
+        pass
@@ -0,0 +1,68 @@
+import ccxt as ccxt
+import numpy as np
+import zlib
+
+
+class OhlcvGenerator:
+    """Deterministic synthetic candles for benchmarks.
+
+    Every candle is a function of (seed, symbol, candle index), so the same
+    range gives the same candles - no matter if it is fetched in one page,
+    in many pages or streamed one by one.
+    """
+
+    block_size = 1000
+
+    def __init__(self, timeframe="1m", seed=42):
+        self.timeframe_ms = ccxt.Exchange.parse_timeframe(timeframe) * 1000
+        self.seed = int(seed)
+
+    def __noise(self, symbol, first, count):
+        """Normal distributed noise (3 values per candle) for the candle indexes."""
+        key = zlib.crc32(symbol.encode())
+        blocks = []
+        for block in range(
+            first // self.block_size, (first + count - 1) // self.block_size + 1
+        ):
+            rng = np.random.default_rng([self.seed, key, block])
+            blocks.append(rng.standard_normal((self.block_size, 3)))
+        offset = first % self.block_size
+
+        return np.concatenate(blocks)[offset : offset + count]
+
+    def __log_close(self, symbol, index, noise):
+        base = np.log(1 + zlib.crc32(symbol.encode()) % 1000)
+        minutes = index * self.timeframe_ms / 60000
+        # Daily and weekly cycles with noise on top
+        return (
+            base
+            + 0.02 * np.sin(2 * np.pi * minutes / 1440)
+            + 0.05 * np.sin(2 * np.pi * minutes / 10080)
+            + 0.002 * noise
+        )
+
+    def candles(self, symbol, since, limit) -> list:
+        """Up to limit candles (ccxt format) starting at the candle containing since."""
+        first = int(since) // self.timeframe_ms
+        noise = self.__noise(symbol, first - 1, limit + 1)
+        index = np.arange(first - 1, first + limit)
+        close = np.exp(self.__log_close(symbol, index, noise[:, 0]))
+
+        open = close[:-1]
+        close = close[1:]
+        high = np.maximum(open, close) * (1 + np.abs(noise[1:, 1]) * 0.001)
+        low = np.minimum(open, close) * (1 - np.abs(noise[1:, 2]) * 0.001)
+        volume = np.exp(3 + noise[1:, 1] * 0.5)
+        timestamp = index[1:] * self.timeframe_ms
+
+        return [
+            [int(row[0]), *row[1:]]
+            for row in zip(
+                timestamp.tolist(),
+                open.tolist(),
+                high.tolist(),
+                low.tolist(),
+                close.tolist(),
+                volume.tolist(),
+            )
+        ]
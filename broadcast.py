@@ -0,0 +1,204 @@
+import asyncio
+
+from logger import LoggerFactory
+
+
+class Broadcast:
+    """Pushes candle and indicator updates to websocket subscribers.
+
+    Clients subscribe to (symbol, timerange, indicator, length) topics. With
+    every closed candle the values of the affected topics are calculated once
+    and fanned out to the send buffers of all subscribed clients. A client
+    which doesn't keep up loses its oldest messages instead of blocking the
+    others.
+    """
+
+    supported_indicators = (
+        "candle",
+        "rsi",
+        "ema",
+        "ema_slope",
+        "ema_distance",
+        "ema_cross",
+        "sma",
+        "sma_slope",
+        "price_action",
+    )
+
+    def __init__(self, loglevel, indicators, buffer_size=100):
+        self.indicators = indicators
+        self.buffer_size = int(buffer_size)
+        self.indicators.data.add_candle_listener(self.on_candle)
+
+        # Class variables
+        Broadcast.status = True
+        # Subscribed client queues per topic per symbol
+        Broadcast.topics = {}
+        # Last published value per topic
+        Broadcast.values = {}
+        Broadcast.events = asyncio.Queue()
+        Broadcast.dropped = 0
+        Broadcast.logging = LoggerFactory.get_logger(
+            "logs/broadcast.log", "broadcast", log_level=loglevel
+        )
+        Broadcast.logging.info("Initialized")
+
+    def connect(self) -> asyncio.Queue:
+        """Create the send buffer of a new client."""
+        return asyncio.Queue(maxsize=self.buffer_size)
+
+    def disconnect(self, client):
+        for topics in list(Broadcast.topics.values()):
+            for topic in list(topics):
+                self.__unsubscribe(client, topic)
+
+    def __topic(self, message):
+        indicator = message.get("indicator", "candle")
+        if indicator not in Broadcast.supported_indicators:
+            raise ValueError(f"Unknown indicator {indicator}")
+        if indicator == "candle":
+            return (message["symbol"], "", indicator, 0)
+
+        return (
+            message["symbol"],
+            message["timerange"],
+            indicator,
+            int(message.get("length", 0)),
+        )
+
+    def __unsubscribe(self, client, topic):
+        topics = Broadcast.topics.get(topic[0], {})
+        clients = topics.get(topic)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del topics[topic]
+                Broadcast.values.pop(topic, None)
+            if not topics:
+                del Broadcast.topics[topic[0]]
+
+    def __send(self, client, message):
+        try:
+            client.put_nowait(message)
+        except asyncio.QueueFull:
+            # Drop the oldest message of slow clients
+            client.get_nowait()
+            client.put_nowait(message)
+            Broadcast.dropped += 1
+
+    def __message(self, topic, timestamp, value):
+        symbol, timerange, indicator, length = topic
+        return {
+            "topic": ":".join(str(part) for part in topic if part),
+            "symbol": symbol,
+            "timerange": timerange,
+            "indicator": indicator,
+            "length": length,
+            "timestamp": timestamp,
+            "value": value,
+        }
+
+    async def handle(self, client, message) -> dict:
+        """Handle a subscribe/unsubscribe message of a client."""
+        try:
+            action = message["action"]
+            topic = self.__topic(message)
+        except Exception as e:
+            return {"result": "", "error": f"Invalid message: {e}"}
+
+        if action == "subscribe":
+            Broadcast.topics.setdefault(topic[0], {}).setdefault(topic, set()).add(
+                client
+            )
+            # Send the actual value right away
+            candle = self.__last_candle(topic[0])
+            if candle is not None:
+                try:
+                    value = await self.__calculate(topic, candle)
+                    self.__send(client, self.__message(topic, int(candle[0]), value))
+                except Exception as e:
+                    Broadcast.logging.error(f"Error calculating {topic}. Cause: {e}")
+        elif action == "unsubscribe":
+            self.__unsubscribe(client, topic)
+        else:
+            return {"result": "", "error": f"Unknown action {action}"}
+
+        return {
+            "result": "ok",
+            "action": action,
+            "topic": self.__message(topic, None, None)["topic"],
+        }
+
+    def __last_candle(self, symbol):
+        buffer = self.indicators.data.candles.get(symbol)
+        if buffer is None:
+            return None
+
+        return buffer.last()
+
+    def on_candle(self, pair, candle):
+        """Candle listener - queue closed candles of subscribed symbols."""
+        if candle is not None and pair in Broadcast.topics:
+            Broadcast.events.put_nowait((pair, candle))
+
+    async def __calculate(self, topic, candle):
+        symbol, timerange, indicator, length = topic
+        match indicator:
+            case "candle":
+                return [float(value) for value in candle]
+            case "rsi":
+                response = await self.indicators.calculate_rsi(
+                    None, symbol, timerange, length
+                )
+            case "ema":
+                response = await self.indicators.calculate_ema(
+                    None, symbol, timerange, length
+                )
+            case "ema_slope":
+                response = await self.indicators.calculate_ema_slope(
+                    None, symbol, timerange, length
+                )
+            case "ema_distance":
+                response = await self.indicators.calculate_ema_distance(
+                    None, symbol, timerange, length
+                )
+            case "ema_cross":
+                response = await self.indicators.calculate_ema_cross(
+                    None, symbol, timerange
+                )
+            case "sma":
+                response = await self.indicators.calculate_sma(symbol, timerange)
+            case "sma_slope":
+                response = await self.indicators.categorize_sma_slope(symbol, timerange)
+            case "price_action":
+                response = await self.indicators.calculate_price_action(
+                    symbol, timerange, length
+                )
+
+        return response["status"]
+
+    async def run(self):
+        while Broadcast.status:
+            try:
+                pair, candle = await asyncio.wait_for(Broadcast.events.get(), 1)
+            except asyncio.TimeoutError:
+                continue
+
+            for topic, clients in list(Broadcast.topics.get(pair, {}).items()):
+                try:
+                    value = await self.__calculate(topic, candle)
+                except Exception as e:
+                    Broadcast.logging.error(f"Error calculating {topic}. Cause: {e}")
+                    continue
+
+                # Only push changed values
+                if Broadcast.values.get(topic) == value:
+                    continue
+                Broadcast.values[topic] = value
+
+                message = self.__message(topic, int(candle[0]), value)
+                for client in list(clients):
+                    self.__send(client, message)
+
+    async def shutdown(self):
+        Broadcast.status = False
@@ -0,0 +1,238 @@
+"""CPU bound indicator calculations.
+
+Plain functions on NumPy arrays, so they can be run in a thread or process
+pool by the Executor without blocking the event loop.
+"""
+
+import numpy as np
+import pandas as pd
+import talib
+
+from scipy.stats import linregress
+
+
+def last_valid(values):
+    """Last non NaN value - raises IndexError if there is none."""
+    values = np.asarray(values, dtype=np.float64)
+    return values[~np.isnan(values)][-1]
+
+
+def resample(timestamp, open, high, low, close, volume, timerange) -> dict:
+    """Resample base candles (timestamps in ms) to the timerange.
+
+    Returns the resampled columns with the timestamp in seconds.
+    """
+    df = pd.DataFrame(
+        {"open": open, "high": high, "close": close, "low": low, "volume": volume},
+        index=pd.to_datetime(
+            np.asarray(timestamp, dtype=np.float64), utc=True, origin="unix", unit="ms"
+        ),
+    )
+    df.index.name = "timestamp"
+
+    # Resample to the configured timerange
+    if "m" in timerange:
+        interval, range = timerange.split("m")
+        timerange = f"{interval}Min"
+
+    df_resample = df.resample(timerange).agg(
+        {
+            "open": "first",
+            "high": "max",
+            "close": "last",
+            "low": "min",
+            "volume": "sum",
+        }
+    )
+
+    # Clear empty values
+    df_resample.dropna(inplace=True)
+
+    return {
+        # Convert datetime object back to a unix timestamp
+        "timestamp": df_resample.index.asi8 / 10**9,
+        **{column: df_resample[column].to_numpy() for column in df_resample.columns},
+    }
+
+
+def rsi(close, length):
+    return last_valid(talib.RSI(close, timeperiod=length))
+
+
+def rsi_last_slope(close, length):
+    return last_valid(np.diff(talib.RSI(close, timeperiod=length)))
+
+
+def ema(close, length):
+    return last_valid(talib.EMA(close, timeperiod=length))
+
+
+def ema_last_slope(close, length):
+    return last_valid(np.diff(talib.EMA(close, timeperiod=length)))
+
+
+def ema_distance(close, length):
+    """Distance of the last close to the EMA in percent."""
+    ema_value = ema(close, length)
+    return abs(last_valid(close) - ema_value) / ema_value * 100
+
+
+def ema_cross(close):
+    ema_short = talib.EMA(close, timeperiod=9)
+    ema_long = talib.EMA(close, timeperiod=21)
+    valid = ~(np.isnan(ema_short) | np.isnan(ema_long))
+    ema_short, ema_long = ema_short[valid], ema_long[valid]
+
+    if ema_short[-2] <= ema_long[-2] and ema_short[-1] >= ema_long[-1]:
+        return "up"
+    elif ema_short[-2] >= ema_long[-2] and ema_short[-1] <= ema_long[-1]:
+        return "down"
+
+    return "none"
+
+
+def price_action(close, length):
+    """Logarithmic return over the last length candles in percent."""
+    return np.log(close[-1] / close[-1 - length]) * 100
+
+
+def sma(close, length):
+    return last_valid(talib.SMA(close, timeperiod=length))
+
+
+def sma_last_slope(close, length):
+    # Difference between the last two SMA values
+    return last_valid(np.diff(talib.SMA(close, timeperiod=length)))
+
+
+def pivots(values, lookback, highs=False) -> np.ndarray:
+    """Indices of the local minima (maxima with highs) of the values.
+
+    A value is a pivot if it is the minimum of the centered window of
+    lookback values around it, like a centered pandas rolling min.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < lookback:
+        return np.empty(0, dtype=np.int64)
+
+    windows = np.lib.stride_tricks.sliding_window_view(values, lookback)
+    extremes = windows.max(axis=1) if highs else windows.min(axis=1)
+    # Window [i - lookback // 2, i - lookback // 2 + lookback) belongs to value i
+    offset = lookback // 2
+    return np.flatnonzero(values[offset : offset + len(extremes)] == extremes) + offset
+
+
+def cluster_levels(prices, merge_tolerance) -> np.ndarray:
+    """Merge prices into levels, sorted ascending.
+
+    A price within merge_tolerance above the previous one joins its group,
+    every group is merged into the average of its prices.
+    """
+    prices = np.unique(np.asarray(prices, dtype=np.float64))
+    if not len(prices):
+        return prices
+
+    groups = np.concatenate(
+        [[0], np.cumsum(prices[1:] > prices[:-1] * (1 + merge_tolerance))]
+    )
+    return np.bincount(groups, weights=prices) / np.bincount(groups)
+
+
+def trend_slope(values):
+    """Slope of the linear regression over the values."""
+    days = np.arange(1, len(values) + 1)
+    slope, intercept, r_value, p_value, std_err = linregress(days, values)
+    return slope
+
+
+def align_right(values):
+    """Move the NaNs of every row of a 2-D array to the left, keeping the order."""
+    order = np.argsort(~np.isnan(values), axis=1, kind="stable")
+    return np.take_along_axis(values, order, axis=1)
+
+
+def ema_rows(values, length):
+    """EMA of every row of a right aligned 2-D array, seeded with the SMA like talib."""
+    count = np.cumsum(~np.isnan(values), axis=1)
+    sums = np.nancumsum(values, axis=1)
+    alpha = 2 / (length + 1)
+    result = np.full(values.shape, np.nan)
+    value = np.full(len(values), np.nan)
+    for column in range(values.shape[1]):
+        value = np.where(
+            count[:, column] == length,
+            sums[:, column] / length,
+            value + alpha * (values[:, column] - value),
+        )
+        result[:, column] = value
+
+    return result
+
+
+def rsi_rows(values, length):
+    """Wilder's RSI of every row of a right aligned 2-D array like talib."""
+    change = np.diff(values, axis=1)
+    gain = np.clip(change, 0, None)
+    loss = np.clip(-change, 0, None)
+    count = np.cumsum(~np.isnan(change), axis=1)
+    gain_sums = np.nancumsum(gain, axis=1)
+    loss_sums = np.nancumsum(loss, axis=1)
+    result = np.full(values.shape, np.nan)
+    average_gain = np.full(len(values), np.nan)
+    average_loss = np.full(len(values), np.nan)
+    for column in range(change.shape[1]):
+        seed = count[:, column] == length
+        average_gain = np.where(
+            seed,
+            gain_sums[:, column] / length,
+            (average_gain * (length - 1) + gain[:, column]) / length,
+        )
+        average_loss = np.where(
+            seed,
+            loss_sums[:, column] / length,
+            (average_loss * (length - 1) + loss[:, column]) / length,
+        )
+        total = average_gain + average_loss
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result[:, column + 1] = np.where(
+                total > 0, 100 * average_gain / total, np.where(total == 0, 0, np.nan)
+            )
+
+    return result
+
+
+def screen(close, rsi_length, ema_length, price_action_length) -> dict:
+    """Indicators of many symbols at once.
+
+    close is a 2-D array with one row of closes per symbol and one column per
+    bucket, NaN where a symbol has no candle. Returns the last value of every
+    indicator per row (NaN if a row is too short). Rows without a close in
+    the newest bucket are stale and get NaN, instead of an old close.
+    """
+    close = np.asarray(close, dtype=np.float64)
+    stale = np.isnan(close[:, -1]) if close.shape[1] else np.ones(len(close), bool)
+    close = align_right(close)
+    close[stale] = np.nan
+    rows, size = close.shape
+    last = close[:, -1] if size else np.full(rows, np.nan)
+    ema = ema_rows(close, ema_length)
+    ema_last = ema[:, -1] if size else np.full(rows, np.nan)
+    ema_previous = ema[:, -2] if size > 1 else np.full(rows, np.nan)
+    rsi = rsi_rows(close, rsi_length)
+    before = (
+        close[:, -1 - price_action_length]
+        if size > price_action_length
+        else np.full(rows, np.nan)
+    )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {
+            "close": last,
+            "rsi": rsi[:, -1] if size else np.full(rows, np.nan),
+            # Distance of the last close to the EMA in percent
+            "ema_distance": np.abs(last - ema_last) / ema_last * 100,
+            # Logarithmic return over price_action_length candles in percent
+            "price_action": np.log(last / before) * 100,
+            # Change of the EMA over the last candle in percent
+            "slope": (ema_last - ema_previous) / ema_previous * 100,
+        }
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+
+def timerange_to_ms(timerange) -> int:
+    """Length of a timerange like 15m, 15min, 4h or 1d in milliseconds."""
+    if timerange.endswith("m"):
+        timerange = f"{timerange[:-1]}min"
+    return int(pd.tseries.frequencies.to_offset(timerange).nanos // 10**6)
+
+
+def native_key(pair, timeframe) -> str:
+    """Key of the natively subscribed candles of a timeframe like BTCUSDT@1h."""
+    return f"{pair}@{timeframe}"
+
+
+class CandleBuffer:
+    """Fixed capacity, array backed store of the most recent candles of a symbol.
+
+    Candles are kept in column arrays of twice the capacity. New candles are
+    appended at the end and once the arrays are full the live window is moved
+    back to the front, so every read is a contiguous (zero copy) slice.
+    """
+
+    columns = ("timestamp", "open", "high", "low", "close", "volume")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamp = np.zeros(capacity * 2, dtype=np.int64)
+        self.open = np.zeros(capacity * 2, dtype=np.float64)
+        self.high = np.zeros(capacity * 2, dtype=np.float64)
+        self.low = np.zeros(capacity * 2, dtype=np.float64)
+        self.close = np.zeros(capacity * 2, dtype=np.float64)
+        self.volume = np.zeros(capacity * 2, dtype=np.float64)
+        self.start = 0
+        self.end = 0
+        # True as long as the buffer holds the complete stored history
+        self.complete = True
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __compact(self):
+        size = len(self)
+        for column in CandleBuffer.columns:
+            array = getattr(self, column)
+            array[:size] = array[self.start : self.end]
+        self.start = 0
+        self.end = size
+
+    def first_timestamp(self):
+        if not len(self):
+            return None
+        return int(self.timestamp[self.start])
+
+    def last_timestamp(self):
+        if not len(self):
+            return None
+        return int(self.timestamp[self.end - 1])
+
+    def append(self, timestamp, open, high, low, close, volume) -> bool:
+        """Append a closed candle. Returns False for out of order candles."""
+        timestamp = int(timestamp)
+        last_timestamp = self.last_timestamp()
+        if last_timestamp is not None and timestamp < last_timestamp:
+            return False
+
+        if last_timestamp is not None and timestamp == last_timestamp:
+            # Same candle again - overwrite it with the latest values
+            position = self.end - 1
+        else:
+            if self.end == self.capacity * 2:
+                self.__compact()
+            position = self.end
+            self.end += 1
+            if len(self) > self.capacity:
+                self.start += 1
+                self.complete = False
+
+        self.timestamp[position] = timestamp
+        self.open[position] = open
+        self.high[position] = high
+        self.low[position] = low
+        self.close[position] = close
+        self.volume[position] = volume
+
+        return True
+
+    def replace(self, timestamp, open, high, low, close, volume) -> bool:
+        """Overwrite a stored candle. Returns False if there is none with the timestamp."""
+        timestamps = self.timestamp[self.start : self.end]
+        offset = np.searchsorted(timestamps, int(timestamp))
+        if offset == len(timestamps) or timestamps[offset] != int(timestamp):
+            return False
+
+        position = self.start + offset
+        self.open[position] = open
+        self.high[position] = high
+        self.low[position] = low
+        self.close[position] = close
+        self.volume[position] = volume
+
+        return True
+
+    def extend(self, rows, complete=True):
+        """Replace the buffer content with the given rows.
+
+        Parameters
+        ----------
+        rows: list
+            List of [timestamp, open, high, low, close, volume] sorted by timestamp
+        complete: bool
+            Whether the rows contain the complete stored history of the symbol
+        """
+        data = np.asarray(rows, dtype=np.float64).reshape(-1, 6)
+        # Drop duplicated candles (keeps the first occurrence)
+        timestamps, index = np.unique(data[:, 0].astype(np.int64), return_index=True)
+        data = data[index]
+        if len(data) > self.capacity:
+            data = data[-self.capacity :]
+            timestamps = timestamps[-self.capacity :]
+            complete = False
+
+        size = len(data)
+        self.timestamp[:size] = timestamps
+        for position, column in enumerate(CandleBuffer.columns[1:], start=1):
+            getattr(self, column)[:size] = data[:, position]
+        self.start = 0
+        self.end = size
+        self.complete = complete
+
+    def last(self):
+        """The newest candle as [timestamp, open, high, low, close, volume]."""
+        if not len(self):
+            return None
+        return [getattr(self, column)[self.end - 1] for column in CandleBuffer.columns]
+
+    def covers(self, timestamp) -> bool:
+        """Check if all stored candles newer than timestamp (ms) are in the buffer."""
+        if self.complete:
+            return True
+        first_timestamp = self.first_timestamp()
+        return first_timestamp is not None and first_timestamp <= timestamp
+
+    def since(self, timestamp) -> dict:
+        """Return views on all candles newer than the given timestamp (ms)."""
+        offset = np.searchsorted(
+            self.timestamp[self.start : self.end], timestamp, side="right"
+        )
+        start = self.start + offset
+        return {
+            column: getattr(self, column)[start : self.end]
+            for column in CandleBuffer.columns
+        }
+
+
+class Candles:
+    """Registry of candle buffers, shared by every Data instance."""
+
+    buffers = {}
+    capacity = 20000
+
+    def __init__(self, capacity=None):
+        if capacity:
+            Candles.capacity = int(capacity)
+
+    def get(self, symbol):
+        return Candles.buffers.get(symbol)
+
+    def append(self, symbol, candle) -> bool:
+        buffer = Candles.buffers.get(symbol)
+        if buffer is None:
+            # Not seeded from the database - reads fall back to the database
+            # until the buffer covers the requested range
+            buffer = Candles.buffers[symbol] = CandleBuffer(Candles.capacity)
+            buffer.complete = False
+        return buffer.append(*candle)
+
+    def seed(self, symbol, rows, complete=True):
+        buffer = CandleBuffer(Candles.capacity)
+        buffer.extend(rows, complete=complete)
+        Candles.buffers[symbol] = buffer
+
+        return buffer
+
+    def remove(self, symbol):
+        Candles.buffers.pop(symbol, None)
@@ -1,14 +1,56 @@
 import pandas as pd
+import numpy as np
 import asyncio
+import calculations
 
+from candles import Candles, timerange_to_ms
+from collections import OrderedDict
 from datetime import datetime, timedelta, UTC
+from executor import Executor
 from logger import LoggerFactory
-from models import Symbols, Tickers
+from models import Symbols
+from registry import SymbolRegistry
+from rollups import Rollups
 from scipy.stats import linregress
+from store import Store
 
 
 class Data:
-    def __init__(self, loglevel):
+    # Callbacks called with (pair, candle) for every closed candle and with
+    # (pair, None) when the candles of a pair got reset
+    candle_listeners = []
+    # Resampled frames per (pair, timerange) in LRU order
+    resample_cache = OrderedDict()
+    resample_cache_size = 256
+    resample_stats = {"hits": 0, "misses": 0, "incremental": 0}
+    # Timestamp (ms) of the last candle seen per pair - None until the first one
+    freshness = {}
+    # Minutes without a new candle until a pair counts as stale
+    stale_threshold = 30
+    # Base candles read from the store at once for paginated and streamed OHLCV
+    ohlcv_block_size = 10000
+
+    def __init__(
+        self,
+        loglevel,
+        candle_buffer_size=None,
+        resample_cache_size=None,
+        rollup_timeranges=None,
+        rollup_size=None,
+        stale_threshold=None,
+        native_timeframes=None,
+        ohlcv_block_size=None,
+    ):
+        self.candles = Candles(candle_buffer_size)
+        self.executor = Executor()
+        self.store = Store()
+        self.rollups = Rollups(rollup_timeranges, rollup_size, native_timeframes)
+        if resample_cache_size:
+            Data.resample_cache_size = int(resample_cache_size)
+        if stale_threshold:
+            Data.stale_threshold = float(stale_threshold)
+        if ohlcv_block_size:
+            Data.ohlcv_block_size = int(ohlcv_block_size)
 
         # Class variables
         Data.status = True
@@ -19,37 +61,54 @@ class Data:
 
     async def data_sanity_check(self):
         while Data.status:
-            data = []
-            symbols = await self.get_symbols()
-            for symbol in symbols:
-                try:
-                    symbol, market = symbol.split("/")
-                    symbol = symbol + market
-                    # Get Dataframe
-                    df = await self.get_data_for_pair(symbol, "15min", 1)
-                    # Convert unix timestamp to datetime object
-                    df["timestamp"] = pd.to_datetime(
-                        df["timestamp"].astype(float),
-                        utc=True,
-                        origin="unix",
-                        unit="ms",
+            for symbol, health in self.get_health()["symbols"].items():
+                if health["last_candle"] is None:
+                    Data.logging.error(
+                        f"No data available yet for {symbol}. If this message exceeds {Data.stale_threshold:g} minutes check the websocket connection. Waiting for data ..."
                     )
-                    actual_date = datetime.now(UTC)
-                    last_candle_date = df["timestamp"].dropna().iloc[-1]
-                    time_difference = actual_date - last_candle_date
-                    if time_difference > timedelta(minutes=30):
-                        Data.logging.error(
-                            f"Old data found for {symbol}, Actual date: {actual_date}, Latest candle date: {last_candle_date} - Check websocket subscription"
-                        )
-                except Exception as e:
+                elif health["stale"]:
                     Data.logging.error(
-                        f"No data available yet for {symbol} or data is to old. If this message exceeds 30 minutes check the websocket connection. Waiting for data ... {e}"
+                        f"Old data found for {symbol}, Lag: {health['lag_seconds']}s, Latest candle date: {health['last_candle']} - Check websocket subscription"
                     )
 
             await asyncio.sleep(60)
 
+    def get_health(self) -> dict:
+        """Lag of the last candle per pair - only from memory, no database access."""
+        now = datetime.now(UTC).timestamp() * 1000
+        symbols = {}
+        for pair, timestamp in Data.freshness.items():
+            if timestamp is None:
+                symbols[pair] = {
+                    "last_candle": None,
+                    "lag_seconds": None,
+                    "stale": True,
+                }
+                continue
+            lag = (now - timestamp) / 1000
+            symbols[pair] = {
+                "last_candle": datetime.fromtimestamp(
+                    timestamp / 1000, UTC
+                ).isoformat(),
+                "lag_seconds": round(lag, 3),
+                "stale": lag > Data.stale_threshold * 60,
+            }
+
+        return {
+            "status": (
+                "degraded"
+                if any(health["stale"] for health in symbols.values())
+                else "ok"
+            ),
+            "stale_threshold": Data.stale_threshold,
+            "symbols": symbols,
+        }
+
     async def get_symbols(self):
-        """Get actual list of symbols from the database."""
+        """Get actual list of symbols - from the registry once it is loaded."""
+        if SymbolRegistry.loaded:
+            return list(SymbolRegistry.symbols)
+
         tickers = None
         try:
             tickers = await Symbols.all().distinct().values_list("symbol", flat=True)
@@ -58,6 +117,76 @@ class Data:
 
         return tickers
 
+    async def load_candles(self, symbols=None):
+        """Seed the in-memory candle buffers with the latest candles from the database."""
+        if symbols is None:
+            symbols = await self.get_symbols()
+
+        for symbol in symbols or []:
+            pair = symbol.replace("/", "")
+            try:
+                columns = await self.store.recent(pair, Candles.capacity)
+                rows = np.column_stack(list(columns.values()))
+                previous = self.candles.get(pair)
+                buffer = self.candles.seed(
+                    pair, rows, complete=len(rows) < Candles.capacity
+                )
+                # Keep live candles which are not written to the database yet
+                if previous is not None and buffer.last_timestamp() is not None:
+                    candles = previous.since(buffer.last_timestamp())
+                    for candle in zip(*candles.values()):
+                        buffer.append(*candle)
+                await self.rollups.build(pair, self.store, self.executor, buffer)
+                Data.freshness[pair] = buffer.last_timestamp()
+                Data.logging.info(
+                    f"Loaded {len(buffer)} candles for {pair} into memory"
+                )
+                self.__invalidate_resample_cache(pair)
+                self.__notify_candle_listeners(pair, None)
+            except Exception as e:
+                Data.logging.error(f"Error loading candles for {pair}. Cause: {e}")
+
+    def add_candle_listener(self, callback):
+        Data.candle_listeners.append(callback)
+
+    def __notify_candle_listeners(self, pair, candle):
+        for callback in Data.candle_listeners:
+            try:
+                callback(pair, candle)
+            except Exception as e:
+                Data.logging.error(f"Error in candle listener for {pair}. Cause: {e}")
+
+    def add_candle(self, pair, candle):
+        """Add a closed candle [timestamp, open, high, low, close, volume] to memory."""
+        if self.candles.append(pair, candle):
+            Data.freshness[pair] = int(candle[0])
+            self.rollups.update(pair, candle)
+            self.__notify_candle_listeners(pair, candle)
+        else:
+            Data.logging.debug(f"Ignoring out of order candle for {pair}: {candle}")
+
+    def add_native_candle(self, pair, timeframe, candle):
+        """Add a closed candle of a natively subscribed timeframe to memory."""
+        self.rollups.update_native(pair, timeframe, candle)
+
+    def remove_candles(self, pair):
+        self.candles.remove(pair)
+        self.rollups.remove(pair)
+        Data.freshness.pop(pair, None)
+        self.__invalidate_resample_cache(pair)
+        self.__notify_candle_listeners(pair, None)
+
+    def __get_buffered_data(self, pair, start_timestamp):
+        buffer = self.candles.get(pair)
+        if buffer is None or not buffer.covers(start_timestamp):
+            return None
+
+        candles = buffer.since(start_timestamp)
+        if not len(candles["timestamp"]):
+            return None
+
+        return pd.DataFrame(candles)
+
     def __calculate_min_date(self, timerange, length):
         # Convert timerange with buffer
         match timerange:
@@ -90,45 +219,128 @@ class Data:
 
         return datetime.timestamp(min_date)
 
-    async def get_ohlcv_for_pair(self, pair, timerange, timestamp_start, offset):
+    def __ohlcv_columns(self, df, offset):
+        """Columns of the OHLCV endpoint from resampled candles."""
+        time = df["timestamp"].to_numpy().astype(np.int64) + 60 * int(offset)
+        # First candle per time
+        _, index = np.unique(time, return_index=True)
+        index.sort()
+
+        # The key order of the records of the endpoint before the formats
+        return {
+            "open": df["open"].to_numpy()[index],
+            "high": df["high"].to_numpy()[index],
+            "close": df["close"].to_numpy()[index],
+            "low": df["low"].to_numpy()[index],
+            "time": time[index],
+        }
+
+    async def get_ohlcv_columns(
+        self, pair, timerange, timestamp_start, offset, end=None
+    ):
+        """Resampled candles as open, high, close, low and time (seconds) arrays.
+
+        time is shifted by offset minutes, only base candles before end (in
+        ms) are used. None if there are no candles.
+        """
         # 600000 --> 60 minutes in milliseconds before
         # start_date = datetime.fromtimestamp(((float(timestamp_start) - 600000) / 1000.0),UTC,)
-        start_timestamp = float(timestamp_start) - 60000
-        ohlcv = {}
-        query = (
-            await Tickers.filter(symbol=pair)
-            .filter(timestamp__gt=start_timestamp)
-            .values("timestamp", "open", "high", "low", "close", "volume")
-        )
+        start_timestamp = int(float(timestamp_start)) - 60000
+        columns = await self.store.read(pair, start_timestamp, end)
+        if not len(columns["timestamp"]):
+            return None
 
-        if query:
-            df = self.resample_data(pd.DataFrame(query), timerange)
-
-            df["time"] = df["timestamp"].astype(int) + 60 * int(offset)
-            df.drop_duplicates(subset=["time"], inplace=True)
-            df.rename(
-                columns={
-                    "open": "open",
-                    "high": "high",
-                    "low": "low",
-                    "close": "close",
-                },
-                inplace=True,
-            )
-            df.drop("volume", axis=1, inplace=True)
-            df.drop("timestamp", axis=1, inplace=True)
-            ohlcv = df.to_json(orient="records")
+        # Ranges ending in the past would replace the cached live series
+        df = await self.resample_data(
+            pd.DataFrame(columns), timerange, pair if end is None else None
+        )
 
-        return ohlcv
+        return self.__ohlcv_columns(df, offset)
+
+    async def iter_ohlcv_columns(
+        self, pair, timerange, timestamp_start, offset, end=None
+    ):
+        """Resampled candles like get_ohlcv_columns in chunks of complete buckets.
+
+        The store is read in blocks of ohlcv_block_size base candles. The
+        candles of the last bucket of a full block are left for the next
+        block, so the chunks are resampled independently and the memory
+        stays bounded by the block size.
+        """
+        period = timerange_to_ms(timerange)
+        cursor = int(float(timestamp_start)) - 60000
+        while True:
+            block = await self.store.read(pair, cursor, end, Data.ohlcv_block_size)
+            timestamps = block["timestamp"]
+            if not len(timestamps):
+                return
+
+            full = len(timestamps) >= Data.ohlcv_block_size
+            if full:
+                bucket = int(timestamps[-1]) - int(timestamps[-1]) % period
+                cut = int(np.searchsorted(timestamps, bucket, "left"))
+                if cut:
+                    block = {name: values[:cut] for name, values in block.items()}
+                else:
+                    # The block is a part of one bucket - read the whole bucket
+                    block = await self.store.read(
+                        pair,
+                        cursor,
+                        bucket + period if end is None else min(bucket + period, end),
+                    )
+            cursor = int(block["timestamp"][-1])
+
+            df = await self.resample_data(pd.DataFrame(block), timerange)
+            yield self.__ohlcv_columns(df, offset)
+
+            if not full:
+                return
+
+    async def get_ohlcv_page(
+        self, pair, timerange, timestamp_start, offset, limit, end=None
+    ):
+        """At most limit resampled candles and the timestamp_start of the next page.
+
+        The cursor is None on the last page, the columns None without candles.
+        """
+        limit = int(limit)
+        chunks, count = [], 0
+        async for chunk in self.iter_ohlcv_columns(
+            pair, timerange, timestamp_start, offset, end
+        ):
+            chunk = {name: values[: limit - count] for name, values in chunk.items()}
+            chunks.append(chunk)
+            count += len(chunk["time"])
+            if count >= limit:
+                break
+
+        if not count:
+            return None, None
+
+        columns = {
+            name: np.concatenate([chunk[name] for chunk in chunks])
+            for name in chunks[0]
+        }
+        cursor = None
+        if count >= limit:
+            # Start of the bucket after the last one
+            cursor = (int(columns["time"][-1]) - 60 * int(offset)) * 1000
+            cursor += timerange_to_ms(timerange)
+
+        return columns, cursor
 
     async def get_data_for_pair(self, pair, timerange, length):
         start_date = self.__calculate_min_date(timerange, length)
-        query = (
-            await Tickers.filter(symbol=pair).filter(timestamp__gt=start_date).values()
-        )
 
-        if query:
-            df = pd.DataFrame(query)
+        # Serve from memory if the buffer covers the requested range
+        df = self.__get_buffered_data(pair, start_date * 1000)
+        if df is not None:
+            return df
+
+        columns = await self.store.read(pair, int(start_date * 1000))
+
+        if len(columns["timestamp"]):
+            df = pd.DataFrame(columns)
 
             df.dropna(inplace=True)
         else:
@@ -136,47 +348,137 @@ class Data:
 
         return df
 
-    def resample_data(self, ohlcv, timerange):
-        df = pd.DataFrame(ohlcv)
-        if not df.empty:
+    async def get_resampled_data(self, pair, timerange, length):
+        """Resampled candles for the lookback of length candles.
 
-            # Convert unix timestamp to datetime object
-            df["timestamp"] = pd.to_datetime(
-                df["timestamp"].astype(float), utc=True, origin="unix", unit="ms"
-            )
-            # Set datetime index
-            df = df.set_index("timestamp")
-
-            # Resample to the configured timerange
-            if "m" in timerange:
-                interval, range = timerange.split("m")
-                timerange = f"{interval}Min"
-
-            df_resample = df.resample(timerange).agg(
-                {
-                    "open": "first",
-                    "high": "max",
-                    "close": "last",
-                    "low": "min",
-                    "volume": "sum",
-                }
-            )
+        Served from the rollups if the timerange is rolled up or natively
+        subscribed, otherwise the base candles get resampled.
+        """
+        start_date = self.__calculate_min_date(timerange, length)
+        df = self.rollups.get(pair, timerange, start_date * 1000)
+        if df is not None:
+            return df
+
+        df_raw = await self.get_data_for_pair(pair, timerange, length)
+        return await self.resample_data(df_raw, timerange, pair)
 
-            # Reset index after resample
-            df_resample.reset_index(inplace=True)
+    def get_rollup_stats(self):
+        return self.rollups.get_stats()
 
-            # Convert datetime object back to a unix timestamp
-            df_resample["timestamp"] = df_resample["timestamp"].astype(int)
-            df_resample["timestamp"] = df_resample["timestamp"].div(10**9)
+    async def resample_data(self, ohlcv, timerange, symbol=None):
+        """Resample base candles to the given timerange.
 
-            # Clear empty values
-            df_resample.dropna(inplace=True)
+        With a symbol the result is served from the resample cache.
+        """
+        df = pd.DataFrame(ohlcv)
+        if not df.empty:
+            if symbol is not None:
+                return await self.__resample_cached(df, timerange, symbol)
 
-            return df_resample
+            return await self.__resample(df, timerange)
         else:
             Data.logging.error("No historic data available yet for symbol")
 
             return None
 
+    async def __resample(self, df, timerange):
+        """Resample in the executor - the columns are passed as arrays."""
+        columns = await self.executor.run(
+            calculations.resample,
+            df["timestamp"].to_numpy(dtype="float64"),
+            df["open"].to_numpy(dtype="float64"),
+            df["high"].to_numpy(dtype="float64"),
+            df["low"].to_numpy(dtype="float64"),
+            df["close"].to_numpy(dtype="float64"),
+            df["volume"].to_numpy(dtype="float64"),
+            timerange,
+        )
+
+        return pd.DataFrame(columns)
+
+    async def __resample_cached(self, df, timerange, symbol):
+        """Resample through a LRU cache of resampled frames per (symbol, timerange).
+
+        An entry is valid for the last base candle timestamp it was built
+        from. A newer base candle invalidates it and only the buckets from
+        the last cached one onwards are resampled and appended. Buckets
+        before the requested window are trimmed from the entry, and a
+        partial first bucket is rebuilt from the requested candles only, so
+        the result matches an uncached resample.
+        """
+        timestamps = df["timestamp"].astype(float)
+        first, last = timestamps.min(), timestamps.max()
+        period = timerange_to_ms(timerange)
+        start = first - first % period
+        key = (symbol, timerange)
+        entry = Data.resample_cache.get(key)
+
+        if entry is not None and entry["first"] <= first and entry["last"] == last:
+            Data.resample_stats["hits"] += 1
+        elif (
+            entry is not None
+            and entry["first"] <= first
+            and entry["last"] < last
+            and first <= entry["last"] - entry["last"] % period
+        ):
+            # Resample the last cached bucket and the new ones only
+            bucket = entry["last"] - entry["last"] % period
+            frame = entry["frame"]
+            entry["frame"] = pd.concat(
+                [
+                    frame[frame["timestamp"] < bucket / 1000],
+                    await self.__resample(df[timestamps >= bucket], timerange),
+                ],
+                ignore_index=True,
+            )
+            entry["last"] = last
+            Data.resample_stats["incremental"] += 1
+        else:
+            entry = {
+                "first": first,
+                "last": last,
+                "frame": await self.__resample(df, timerange),
+            }
+            Data.resample_cache[key] = entry
+            Data.resample_stats["misses"] += 1
+
+        # Drop the buckets before the requested window from the entry
+        if entry["first"] < start:
+            frame = entry["frame"]
+            entry["frame"] = frame[frame["timestamp"] >= start / 1000].reset_index(
+                drop=True
+            )
+            entry["first"] = start
+
+        Data.resample_cache.move_to_end(key)
+        while len(Data.resample_cache) > Data.resample_cache_size:
+            Data.resample_cache.popitem(last=False)
+
+        frame = entry["frame"]
+        if entry["first"] == first:
+            return frame[frame["timestamp"] >= start / 1000].reset_index(drop=True)
+
+        # The entry holds earlier candles of the first bucket - rebuild it
+        # from the requested candles only
+        end = start + period
+        return pd.concat(
+            [
+                await self.__resample(df[timestamps < end], timerange),
+                frame[frame["timestamp"] >= end / 1000],
+            ],
+            ignore_index=True,
+        )
+
+    def __invalidate_resample_cache(self, pair):
+        for key in [key for key in Data.resample_cache if key[0] == pair]:
+            del Data.resample_cache[key]
+
+    def get_resample_cache_stats(self):
+        return {
+            **Data.resample_stats,
+            "size": len(Data.resample_cache),
+            "max_size": Data.resample_cache_size,
+        }
+
     async def shutdown(self):
         Data.status = False
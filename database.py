@@ -1,48 +1,336 @@
 import asyncio
 import datetime
+import itertools
+import sys
+import time
 
 from tortoise import Tortoise, run_async
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.transactions import in_transaction
+from candles import native_key
 from logger import LoggerFactory
-from models import Tickers
+from store import Store
+
+
+class ReadRouter:
+    """Routes the ORM reads round robin to the read-only connections."""
+
+    connections = []
+    counter = itertools.count()
+
+    def db_for_read(self, model):
+        if ReadRouter.connections:
+            return ReadRouter.connections[
+                next(ReadRouter.counter) % len(ReadRouter.connections)
+            ]
+        return None
 
 
 class Database:
-    def __init__(self, db_file, loglevel, housekeeping_interval):
-        self.db_housekeeping_interval = housekeeping_interval
+    # Version of the database schema (stored in PRAGMA user_version)
+    # 1: Tickers with integer millisecond timestamps and a (symbol, timestamp) index
+    # 2: Incremental auto vacuum
+    schema_version = 2
+
+    def __init__(
+        self,
+        db_file,
+        loglevel,
+        housekeeping_retention=0,
+        retention=None,
+        housekeeping_chunk_size=5000,
+        housekeeping_interval=60,
+        pragmas=None,
+        read_connections=0,
+        url=None,
+        pool_size=10,
+        native_timeframes=None,
+    ):
+        # Age in minutes after which candles get deleted - 0 keeps them
+        self.housekeeping_retention = int(housekeeping_retention or 0)
+        # Minutes between two housekeeping runs
+        self.housekeeping_interval = float(housekeeping_interval)
+        self.retention = self.__parse_retention(retention)
+        self.housekeeping_chunk_size = int(housekeeping_chunk_size)
         # Logging
         Database.logging = LoggerFactory.get_logger(
             "logs/database.log", "database", log_level=loglevel
         )
         Database.logging.info("Initialized")
         self.db_file = db_file
+        self.store = Store()
+        # Applied to every connection, journal_mode first
+        self.pragmas = {
+            key: (
+                int(value) if isinstance(value, float) and value.is_integer() else value
+            )
+            for key, value in {"journal_mode": "WAL", **(pragmas or {})}.items()
+        }
+        self.read_connections = int(read_connections)
+        # PostgreSQL if an URL is given, SQLite otherwise
+        self.url = url
+        self.pool_size = int(pool_size)
+        # Native candles are stored as BTCUSDT@1h and share the retention of the symbol
+        self.native_timeframes = list(native_timeframes or [])
 
         # Class variables
         Database.status = True
+        Database.housekeeping_stats = {
+            "runs": 0,
+            "last_run": None,
+            "deleted": 0,
+            "seconds": 0.0,
+            "vacuumed_pages": 0,
+        }
+
+    def __parse_retention(self, retention) -> dict:
+        """Parse per symbol retention like "BTCUSDT:525600, ETH/USDT:43200" (minutes)."""
+        policies = {}
+        invalid = []
+        for policy in str(retention or "").split(","):
+            if not policy.strip():
+                continue
+            symbol, _, minutes = policy.rpartition(":")
+            symbol = symbol.strip().replace("/", "")
+            try:
+                minutes = int(minutes)
+            except ValueError:
+                minutes = 0
+            if not symbol or minutes <= 0:
+                invalid.append(policy.strip())
+                continue
+            policies[symbol] = minutes
+
+        if invalid:
+            sys.tracebacklimit = 0
+            sys.exit(
+                f"Invalid retention {', '.join(invalid)} - expected SYMBOL:minutes like BTCUSDT:525600"
+            )
+
+        return policies
+
+    def __config(self) -> dict:
+        """Tortoise config with the write connection and the read-only pool."""
+        if self.url:
+            # asyncpg brings its own connection pool
+            connection = expand_db_url(self.url)
+            connection["credentials"].update({"minsize": 1, "maxsize": self.pool_size})
+            ReadRouter.connections = []
+            return {
+                "connections": {"default": connection},
+                "apps": {
+                    "models": {"models": ["models"], "default_connection": "default"}
+                },
+            }
+
+        connections = {
+            "default": {
+                "engine": "tortoise.backends.sqlite",
+                "credentials": {"file_path": f"db/{self.db_file}", **self.pragmas},
+            }
+        }
+        ReadRouter.connections = [f"read{i}" for i in range(self.read_connections)]
+        for name in ReadRouter.connections:
+            connections[name] = {
+                "engine": "tortoise.backends.sqlite",
+                "credentials": {
+                    "file_path": f"db/{self.db_file}",
+                    **self.pragmas,
+                    "query_only": "ON",
+                },
+            }
+
+        return {
+            "connections": connections,
+            "apps": {"models": {"models": ["models"], "default_connection": "default"}},
+            "routers": [ReadRouter] if ReadRouter.connections else [],
+        }
 
     async def init(self):
-        await Tortoise.init(
-            db_url=f"sqlite://db/{self.db_file}", modules={"models": ["models"]}
+        await Tortoise.init(config=self.__config())
+        if self.url:
+            Database.logging.info(
+                f"Opened PostgreSQL database with a pool of {self.pool_size} connections"
+            )
+            await Tortoise.generate_schemas()
+            await self.store.setup()
+            return
+
+        Database.logging.info(
+            f"Opened database with {self.pragmas} and {self.read_connections} read connections"
         )
+        connection = Tortoise.get_connection("default")
+        _, rows = await connection.execute_query("PRAGMA user_version")
+        version = rows[0][0]
+
+        if version < 1:
+            await self.__prepare_tickers_migration(connection)
+
         # Generate the schema
         await Tortoise.generate_schemas()
 
-    async def cleanup(self):
-        while Database.status:
-            actual_timestamp = datetime.datetime.now()
-            cleanup_timestamp = actual_timestamp - datetime.timedelta(
-                minutes=self.db_housekeeping_interval
+        if version < 1:
+            await self.__migrate_tickers()
+
+        if version < 2:
+            await self.__enable_incremental_vacuum(connection)
+
+        await connection.execute_script(
+            f"PRAGMA user_version = {Database.schema_version}"
+        )
+        await self.store.setup()
+
+    async def __prepare_tickers_migration(self, connection):
+        """Move a Tickers table with text timestamps out of the way."""
+        _, rows = await connection.execute_query(
+            "SELECT type FROM pragma_table_info('tickers') WHERE name = 'timestamp'"
+        )
+        if rows and rows[0][0].upper() == "TEXT":
+            Database.logging.info(
+                "Found Tickers table with text timestamps - starting migration"
             )
-            try:
-                query = await Tickers.filter(
-                    timestamp__lt=cleanup_timestamp.timestamp()
-                ).delete()
+            await connection.execute_script(
+                'ALTER TABLE "tickers" RENAME TO "tickers_legacy"'
+            )
+
+    async def __migrate_tickers(self, chunk_size=100000):
+        """Copy the legacy Tickers rows into the new table with integer timestamps.
+
+        Runs in one transaction, so an interrupted migration starts over with
+        the next startup.
+        """
+        connection = Tortoise.get_connection("default")
+        _, rows = await connection.execute_query(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tickers_legacy'"
+        )
+        if not rows:
+            return
+
+        start_time = datetime.datetime.now()
+        async with in_transaction("default") as transaction:
+            _, rows = await transaction.execute_query(
+                'SELECT COALESCE(MAX("id"), 0) FROM "tickers_legacy"'
+            )
+            max_id = rows[0][0]
+            for offset in range(0, max_id, chunk_size):
+                await transaction.execute_query(
+                    'INSERT INTO "tickers" ("id", "timestamp", "symbol", "open", "high", "low", "close", "volume") '
+                    'SELECT "id", CAST(CAST("timestamp" AS REAL) AS INTEGER), "symbol", "open", "high", "low", "close", "volume" '
+                    'FROM "tickers_legacy" WHERE "id" > ? AND "id" <= ?',
+                    [offset, offset + chunk_size],
+                )
                 Database.logging.info(
-                    f"Start housekeeping. Delete {query} entries older then {cleanup_timestamp}"
+                    f"Migrating Tickers table: {min(offset + chunk_size, max_id)}/{max_id}"
+                )
+                await asyncio.sleep(0)
+            await transaction.execute_script('DROP TABLE "tickers_legacy"')
+
+        Database.logging.info(
+            f"Migrated Tickers table in {datetime.datetime.now() - start_time}"
+        )
+
+    async def __enable_incremental_vacuum(self, connection):
+        """Switch to incremental auto vacuum - needs one full VACUUM."""
+        _, rows = await connection.execute_query("PRAGMA auto_vacuum")
+        if rows[0][0] != 2:
+            start_time = datetime.datetime.now()
+            await connection.execute_script("PRAGMA auto_vacuum = INCREMENTAL")
+            await connection.execute_script("VACUUM")
+            Database.logging.info(
+                f"Enabled incremental vacuum in {datetime.datetime.now() - start_time}"
+            )
+
+    async def __incremental_vacuum(self, pages=1000) -> int:
+        """Give free pages back to the file system in steps of pages."""
+        if self.url:
+            # PostgreSQL reclaims the space with autovacuum
+            return 0
+
+        connection = Tortoise.get_connection("default")
+        _, rows = await connection.execute_query("PRAGMA auto_vacuum")
+        if rows[0][0] != 2:
+            return 0
+
+        vacuumed = 0
+        while Database.status:
+            _, rows = await connection.execute_query("PRAGMA freelist_count")
+            free_pages = rows[0][0]
+            if not free_pages:
+                break
+            await connection.execute_script(
+                f"PRAGMA incremental_vacuum({min(pages, free_pages)})"
+            )
+            _, rows = await connection.execute_query("PRAGMA freelist_count")
+            if rows[0][0] >= free_pages:
+                break
+            vacuumed += free_pages - rows[0][0]
+            await asyncio.sleep(0)
+
+        return vacuumed
+
+    def __keys(self, symbol) -> list:
+        """Store keys of the base and native candles of a symbol."""
+        return [symbol] + [
+            native_key(symbol, timeframe) for timeframe in self.native_timeframes
+        ]
+
+    def __timestamp(self, minutes) -> int:
+        """Timestamp in ms of the given minutes ago."""
+        cleanup_timestamp = datetime.datetime.now() - datetime.timedelta(
+            minutes=minutes
+        )
+        return int(cleanup_timestamp.timestamp() * 1000)
+
+    async def housekeeping(self) -> dict:
+        """Delete the candles outside their retention and reclaim the space."""
+        start_time = time.perf_counter()
+        deleted = 0
+        if self.housekeeping_retention > 0:
+            # Symbols with their own retention are handled separately
+            deleted += await self.store.cleanup(
+                self.__timestamp(self.housekeeping_retention),
+                exclude=[
+                    key for symbol in self.retention for key in self.__keys(symbol)
+                ],
+                chunk_size=self.housekeeping_chunk_size,
+            )
+        for symbol, minutes in self.retention.items():
+            for key in self.__keys(symbol):
+                deleted += await self.store.cleanup(
+                    self.__timestamp(minutes),
+                    pair=key,
+                    chunk_size=self.housekeeping_chunk_size,
                 )
+        vacuumed = await self.__incremental_vacuum()
+
+        stats = Database.housekeeping_stats
+        stats["runs"] += 1
+        stats["last_run"] = datetime.datetime.now(datetime.UTC).isoformat()
+        stats["deleted"] = deleted
+        stats["seconds"] = round(time.perf_counter() - start_time, 3)
+        stats["vacuumed_pages"] = vacuumed
+        Database.logging.info(
+            f"Housekeeping deleted {deleted} candles and vacuumed {vacuumed} pages in {stats['seconds']}s"
+        )
+
+        return stats
+
+    def get_housekeeping_stats(self):
+        return {
+            **Database.housekeeping_stats,
+            "retention": self.housekeeping_retention,
+            "interval": self.housekeeping_interval,
+            "symbol_retention": self.retention,
+        }
+
+    async def cleanup(self):
+        while Database.status:
+            try:
+                await self.housekeeping()
             except Exception as e:
                 Database.logging.error(f"Error db housekeeping: {e}")
 
-            await asyncio.sleep(self.db_housekeeping_interval)
+            await asyncio.sleep(self.housekeeping_interval * 60)
 
     async def shutdown(self):
         Database.status = False
@@ -0,0 +1,223 @@
+from collections import OrderedDict, deque
+
+from candles import Candles, timerange_to_ms
+from logger import LoggerFactory
+
+
+class StreamingEMA:
+    """EMA updated one close at a time - seeded with the SMA like talib."""
+
+    def __init__(self, length):
+        self.length = length
+        self.alpha = 2 / (length + 1)
+        self.count = 0
+        self.total = 0.0
+        self.value = None
+
+    def update(self, close):
+        self.count += 1
+        if self.value is None:
+            self.total += close
+            if self.count == self.length:
+                self.value = self.total / self.length
+        else:
+            self.value = (close - self.value) * self.alpha + self.value
+
+    def peek(self, close):
+        """Value if close was the next committed close - without committing it."""
+        if self.value is None:
+            if self.count + 1 == self.length:
+                return (self.total + close) / self.length
+            return None
+        return (close - self.value) * self.alpha + self.value
+
+
+class StreamingRSI:
+    """RSI with Wilder's smoothing updated one close at a time like talib."""
+
+    def __init__(self, length):
+        self.length = length
+        self.previous = None
+        self.count = 0
+        self.gain = 0.0
+        self.loss = 0.0
+        self.value = None
+
+    def __next_state(self, close):
+        if self.previous is None:
+            return 0, 0.0, 0.0
+
+        change = close - self.previous
+        gain = max(change, 0.0)
+        loss = max(-change, 0.0)
+        count = self.count + 1
+        if count < self.length:
+            # Sums of the first period
+            return count, self.gain + gain, self.loss + loss
+        if count == self.length:
+            return count, (self.gain + gain) / count, (self.loss + loss) / count
+        return (
+            count,
+            (self.gain * (self.length - 1) + gain) / self.length,
+            (self.loss * (self.length - 1) + loss) / self.length,
+        )
+
+    def __rsi(self, count, gain, loss):
+        if count < self.length:
+            return None
+        if gain + loss == 0:
+            return 0.0
+        return 100 * gain / (gain + loss)
+
+    def update(self, close):
+        self.count, self.gain, self.loss = self.__next_state(close)
+        self.value = self.__rsi(self.count, self.gain, self.loss)
+        self.previous = close
+
+    def peek(self, close):
+        """Value if close was the next committed close - without committing it."""
+        return self.__rsi(*self.__next_state(close))
+
+
+class StreamingSMA:
+    """SMA over a sliding window of closes."""
+
+    def __init__(self, length):
+        self.length = length
+        self.window = deque(maxlen=length)
+        self.total = 0.0
+        self.updates = 0
+        self.value = None
+
+    def update(self, close):
+        if len(self.window) == self.length:
+            self.total -= self.window[0]
+        self.window.append(close)
+        self.total += close
+        self.updates += 1
+        if self.updates % self.length == 0:
+            # Get rid of accumulated floating point errors
+            self.total = sum(self.window)
+        if len(self.window) == self.length:
+            self.value = self.total / self.length
+
+    def peek(self, close):
+        """Value if close was the next committed close - without committing it."""
+        if len(self.window) == self.length:
+            return (self.total - self.window[0] + close) / self.length
+        if len(self.window) + 1 == self.length:
+            return (self.total + close) / self.length
+        return None
+
+
+class IndicatorStream:
+    """Indicator state of one (symbol, timerange, length) on resampled candles.
+
+    The indicator holds the state up to the last completed bucket of the
+    timerange, the close of the running bucket is applied on read only.
+    """
+
+    indicators = {"ema": StreamingEMA, "rsi": StreamingRSI, "sma": StreamingSMA}
+
+    def __init__(self, indicator, length, timerange):
+        self.indicator = IndicatorStream.indicators[indicator](length)
+        self.period = timerange_to_ms(timerange)
+        self.bucket = None
+        self.close = None
+        self.last_timestamp = None
+
+    def update(self, timestamp, close):
+        """Apply a base candle (timestamp in ms)."""
+        timestamp = int(timestamp)
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            return
+
+        bucket = timestamp - timestamp % self.period
+        if self.bucket is not None and bucket > self.bucket:
+            self.indicator.update(self.close)
+        self.bucket = bucket
+        self.close = close
+        self.last_timestamp = timestamp
+
+    def warmup(self, timestamps, closes, last_timestamp):
+        """Replay resampled closes (timestamps in ms), the last one is the running bucket."""
+        for close in closes[:-1]:
+            self.indicator.update(close)
+        if len(closes):
+            self.bucket = int(timestamps[-1])
+            self.close = closes[-1]
+            self.last_timestamp = int(last_timestamp)
+
+    def value(self):
+        if self.close is None:
+            return None
+        return self.indicator.peek(self.close)
+
+    def previous(self):
+        """Value at the last completed bucket."""
+        return self.indicator.value
+
+
+class IndicatorEngine:
+    """Keeps streaming indicator state per (symbol, timerange, indicator, length).
+
+    Streams are warmed up once from a full history and then updated in O(1)
+    with every closed candle. Each symbol keeps at most max_streams streams,
+    the least recently used ones get evicted. The streams of a symbol are
+    dropped with its candles.
+    """
+
+    streams = {}
+    max_streams = 64
+
+    def __init__(self, loglevel, max_streams=None):
+        self.candles = Candles()
+        if max_streams:
+            IndicatorEngine.max_streams = int(max_streams)
+
+        IndicatorEngine.logging = LoggerFactory.get_logger(
+            "logs/engine.log", "engine", log_level=loglevel
+        )
+        IndicatorEngine.logging.info("Initialized")
+
+    def get(self, symbol, timerange, indicator, length):
+        streams = IndicatorEngine.streams.get(symbol)
+        key = (timerange, indicator, length)
+        if streams is None or key not in streams:
+            return None
+
+        streams.move_to_end(key)
+        return streams[key]
+
+    def warmup(self, symbol, timerange, indicator, length, df, last_timestamp):
+        """Create a stream from a resampled DataFrame (timestamps in seconds)."""
+        stream = IndicatorStream(indicator, length, timerange)
+        timestamps = (df["timestamp"].to_numpy() * 1000).round().astype("int64")
+        stream.warmup(timestamps, df["close"].to_numpy(), last_timestamp)
+
+        # Apply candles which arrived while the history was fetched
+        buffer = self.candles.get(symbol)
+        if buffer is not None and stream.last_timestamp is not None:
+            candles = buffer.since(stream.last_timestamp)
+            for timestamp, close in zip(candles["timestamp"], candles["close"]):
+                stream.update(timestamp, close)
+
+        streams = IndicatorEngine.streams.setdefault(symbol, OrderedDict())
+        streams[(timerange, indicator, length)] = stream
+        streams.move_to_end((timerange, indicator, length))
+        while len(streams) > IndicatorEngine.max_streams:
+            streams.popitem(last=False)
+        IndicatorEngine.logging.debug(
+            f"Warmed up {indicator}{length} for {symbol}@{timerange} with {len(df)} candles"
+        )
+
+        return stream
+
+    def update(self, symbol, candle):
+        """Candle listener - a candle of None resets the symbol."""
+        if candle is None:
+            IndicatorEngine.streams.pop(symbol, None)
+            return
+
+        for stream in IndicatorEngine.streams.get(symbol, {}).values():
+            stream.update(candle[0], candle[4])
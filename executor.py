@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from metrics import Metrics
+
+
+class Executor:
+    """Runs CPU bound calculations in a thread or process pool.
+
+    The pool is shared by every instance and created on first use with the
+    configured type and size.
+    """
+
+    pool = None
+    kind = "thread"
+    workers = 4
+    # Submitted calculations which are not finished yet
+    pending = 0
+
+    def __init__(self, kind=None, workers=None):
+        self.metrics = Metrics()
+        if kind:
+            Executor.kind = kind
+        if workers:
+            Executor.workers = int(workers)
+
+    def __get_pool(self):
+        if Executor.pool is None:
+            if Executor.kind == "process":
+                Executor.pool = ProcessPoolExecutor(max_workers=Executor.workers)
+            else:
+                Executor.pool = ThreadPoolExecutor(
+                    max_workers=Executor.workers, thread_name_prefix="moonloader"
+                )
+        return Executor.pool
+
+    async def run(self, func, *args):
+        """Run func(*args) in the pool - func and args have to be picklable for processes."""
+        loop = asyncio.get_running_loop()
+        Executor.pending += 1
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.__get_pool(), func, *args)
+        finally:
+            Executor.pending -= 1
+            # Including the time waiting for a free worker
+            self.metrics.stage(
+                (
+                    "resample"
+                    if getattr(func, "__name__", None) == "resample"
+                    else "compute"
+                ),
+                time.perf_counter() - start,
+            )
+
+    def get_stats(self):
+        return {
+            "type": Executor.kind,
+            "workers": Executor.workers,
+            # More pending calculations than workers are waiting in the queue
+            "queue_depth": max(Executor.pending - Executor.workers, 0),
+            "pending": Executor.pending,
+        }
+
+    def shutdown(self):
+        if Executor.pool is not None:
+            Executor.pool.shutdown(wait=False, cancel_futures=True)
+            Executor.pool = None
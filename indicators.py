@@ -1,32 +1,115 @@
+import calculations
 import pandas as pd
 import numpy as np
-import talib
 
 from data import Data
+from engine import IndicatorEngine
+from levels import Levels
 from datetime import datetime, timedelta
 from logger import LoggerFactory
 from models import Global
-from scipy.stats import linregress
 
 
 class Indicators:
-    def __init__(self, loglevel, currency, timeframe):
+    def __init__(self, loglevel, currency, timeframe, indicator_streams=None):
         self.currency = currency
         self.data = Data(loglevel)
+        self.executor = self.data.executor
         self.timeframe = timeframe
+        self.engine = IndicatorEngine(loglevel, indicator_streams)
+        self.data.add_candle_listener(self.engine.update)
+        self.levels = Levels(loglevel)
 
         Indicators.logging = LoggerFactory.get_logger(
             "logs/indicators.log", "indicator", log_level=loglevel
         )
         Indicators.logging.info("Initialized")
 
+    async def __get_stream(self, symbol, timerange, indicator, length):
+        """Get the streaming indicator - warmed up from history on first use."""
+        stream = self.engine.get(symbol, timerange, indicator, length)
+        if stream is None:
+            df_raw = await self.data.get_data_for_pair(symbol, timerange, length)
+            df = await self.data.resample_data(df_raw, timerange, symbol)
+            if df is None or df.empty:
+                raise ValueError(f"No history data available for {symbol}")
+            stream = self.engine.warmup(
+                symbol,
+                timerange,
+                indicator,
+                length,
+                df,
+                float(df_raw["timestamp"].iloc[-1]),
+            )
+
+        return stream
+
+    def __close(self, df):
+        return df["close"].to_numpy(dtype="float64")
+
+    async def __rsi(self, df, length):
+        return await self.executor.run(calculations.rsi, self.__close(df), length)
+
+    async def __ema(self, df, length):
+        return await self.executor.run(calculations.ema, self.__close(df), length)
+
+    async def __ema_last_slope(self, df, length):
+        return await self.executor.run(
+            calculations.ema_last_slope, self.__close(df), length
+        )
+
+    async def __ema_distance(self, df, length):
+        percentage_diff = await self.executor.run(
+            calculations.ema_distance, self.__close(df), length
+        )
+        Indicators.logging.debug(
+            f"close_price: {df['close'].iloc[-1]}, percentage diff: {percentage_diff}"
+        )
+        return bool(percentage_diff < 2)
+
+    async def __ema_cross(self, df):
+        return await self.executor.run(calculations.ema_cross, self.__close(df))
+
+    async def __price_action(self, df, length):
+        return await self.executor.run(
+            calculations.price_action, self.__close(df), length
+        )
+
+    async def __sma(self, df, length):
+        return await self.executor.run(calculations.sma, self.__close(df), length)
+
+    async def __sma_last_slope(self, df, length):
+        return await self.executor.run(
+            calculations.sma_last_slope, self.__close(df), length
+        )
+
+    def __categorize_slope(self, slope):
+        if slope > 0:
+            return "upward"
+        elif slope < 0:
+            return "downward"
+
+        return "flat"
+
+    async def __ema_slope(self, df, length):
+        return self.__categorize_slope(await self.__ema_last_slope(df, length))
+
+    async def __sma_slope(self, df, length):
+        return self.__categorize_slope(await self.__sma_last_slope(df, length))
+
+    async def __support(self, symbol, timerange, num_levels):
+        levels = await self.levels.get_levels(symbol, timerange, num_levels)
+        if levels is None:
+            return ""
+
+        return str(levels["near_support"])
+
     async def calculate_24h_volume_data(self, df, symbol, timerange, length):
         try:
             if df is None:
-                df_raw = await self.data.get_data_for_pair(symbol, timerange, length)
+                df = await self.data.get_resampled_data(symbol, timerange, length)
             else:
-                df_raw = df
-            df = self.data.resample_data(df_raw, timerange)
+                df = await self.data.resample_data(df, timerange, symbol)
             df_1d = df.tail(24)
             quote_volume = df_1d.apply(
                 lambda row: (row["close"] * row["volume"]), axis=1
@@ -41,35 +124,27 @@ class Indicators:
         result = False
         try:
             if df is None:
-                df_raw = await self.data.get_data_for_pair(symbol, timerange, length)
+                df = await self.data.get_resampled_data(symbol, timerange, length)
             else:
-                df_raw = df
-            df = self.data.resample_data(df_raw, timerange)
-            ema = talib.EMA(df["close"], timeperiod=length)
-            ema = ema.dropna().iloc[-1]
-            close_price = df["close"].dropna().iloc[-1]
-            percentage_diff = abs(close_price - ema) / ema * 100
-            Indicators.logging.debug(
-                f"close_price: {close_price}, ema: {ema}, percentage diff: {percentage_diff}"
-            )
-            if percentage_diff < 2:
-                result = True
+                df = await self.data.resample_data(df, timerange, symbol)
+            result = await self.__ema_distance(df, length)
         except Exception as e:
             Indicators.logging.info(
                 f"EMA Distance cannot be calculated, because we don't have enough history data: {e}"
             )
         return {"status": result}
 
-    async def calculate_ema_slope(self, df, symbol, timerange, length):
+    async def calculate_ema_slope(self, df, symbol, timerange, length, full=False):
         try:
-            if df is None:
-                df_raw = await self.data.get_data_for_pair(symbol, timerange, length)
+            if df is None and not full:
+                stream = await self.__get_stream(symbol, timerange, "ema", length)
+                ema_last_slope = stream.value() - stream.previous()
             else:
-                df_raw = df
-            df = self.data.resample_data(df_raw, timerange)
-            ema = talib.EMA(df["close"], timeperiod=length)
-            ema_slope = ema.diff()
-            ema_last_slope = ema_slope.dropna().iloc[-1]
+                if df is None:
+                    df = await self.data.get_resampled_data(symbol, timerange, length)
+                else:
+                    df = await self.data.resample_data(df, timerange, symbol)
+                ema_last_slope = await self.__ema_last_slope(df, length)
             if ema_last_slope:
                 if ema_last_slope > 0:
                     categories = "upward"
@@ -89,9 +164,9 @@ class Indicators:
         try:
             if df is None:
                 df = await self.data.get_data_for_pair(symbol, timerange, length)
-            rsi = talib.RSI(df["close"], timeperiod=length)
-            rsi_slope = rsi.diff()
-            rsi_last_slope = rsi_slope.dropna().iloc[-1]
+            rsi_last_slope = await self.executor.run(
+                calculations.rsi_last_slope, self.__close(df), length
+            )
             categories = "flat"
             if rsi_last_slope:
                 if rsi_last_slope > 0:
@@ -106,54 +181,43 @@ class Indicators:
             )
         return {"status": result}
 
-    async def calculate_rsi(self, df, symbol, timerange, length):
+    async def calculate_rsi(self, df, symbol, timerange, length, full=False):
         try:
-            if df is None:
-                df_raw = await self.data.get_data_for_pair(symbol, timerange, length)
+            if df is None and not full:
+                stream = await self.__get_stream(symbol, timerange, "rsi", length)
+                rsi = stream.value()
+                if rsi is None:
+                    rsi = ""
             else:
-                df_raw = df
-            df = self.data.resample_data(df_raw, timerange)
-            rsi = talib.RSI(df["close"], timeperiod=length).dropna().iloc[-1]
+                if df is None:
+                    df = await self.data.get_resampled_data(symbol, timerange, length)
+                else:
+                    df = await self.data.resample_data(df, timerange, symbol)
+                rsi = await self.__rsi(df, length)
         except:
             rsi = ""
         return {"status": rsi}
 
     async def calculate_price_action(self, symbol, timerange, length):
         price_action = 0
-        df = await self.data.get_data_for_pair(symbol, timerange, length)
-        df_resample = self.data.resample_data(df, timerange)
+        df_resample = await self.data.get_resampled_data(symbol, timerange, length)
 
         try:
-            price_action = (np.log(df_resample["close"].pct_change(length) + 1)) * 100
-            price_action = price_action.dropna().iloc[-1]
+            price_action = await self.__price_action(df_resample, length)
         except:
             price_action = ""
 
         return {"status": price_action}
 
-    async def calculate_ema_cross(self, symbol, timerange):
+    async def calculate_ema_cross(self, df, symbol, timerange):
         result = None
-        df_raw = await self.data.get_data_for_pair(symbol, timerange, 21)
-        df = self.data.resample_data(df_raw, timerange)
-        df["ema_short"] = talib.EMA(df["close"], timeperiod=9)
-        df["ema_long"] = talib.EMA(df["close"], timeperiod=21)
-        df.dropna(subset=["ema_short", "ema_long"], inplace=True)
+        if df is None:
+            df = await self.data.get_resampled_data(symbol, timerange, 21)
+        else:
+            df = await self.data.resample_data(df, timerange, symbol)
 
         try:
-
-            if (
-                df.iloc[-2]["ema_short"] <= df.iloc[-2]["ema_long"]
-                and df.iloc[-1]["ema_short"] >= df.iloc[-1]["ema_long"]
-            ):
-                result = "up"
-            elif (
-                df.iloc[-2]["ema_short"] >= df.iloc[-2]["ema_long"]
-                and df.iloc[-1]["ema_short"] <= df.iloc[-1]["ema_long"]
-            ):
-                result = "down"
-            else:
-                result = "none"
-
+            result = await self.__ema_cross(df)
         except Exception as e:
             Indicators.logging.error(
                 f"EMA Cross cannot be calculated for {symbol}. Cause: {e}"
@@ -161,16 +225,25 @@ class Indicators:
 
         return {"status": result}
 
-    async def calculate_ema(self, df, symbol, timerange, length):
+    async def calculate_ema(self, df, symbol, timerange, length, full=False):
+        if df is None and not full:
+            try:
+                stream = await self.__get_stream(symbol, timerange, "ema", length)
+                ema = stream.value()
+                if ema is None:
+                    ema = ""
+            except:
+                ema = ""
+
+            return {"status": ema}
+
         if df is None:
-            df_raw = await self.data.get_data_for_pair(symbol, timerange, length)
+            df = await self.data.get_resampled_data(symbol, timerange, length)
         else:
-            df_raw = df
-        df = self.data.resample_data(df_raw, timerange)
+            df = await self.data.resample_data(df, timerange, symbol)
 
         try:
-            ema = talib.EMA(df["close"], timeperiod=length)
-            ema = ema.dropna().iloc[-1]
+            ema = await self.__ema(df, length)
         except:
             ema = ""
 
@@ -198,21 +271,22 @@ class Indicators:
 
         return {"status": btc_pulse}
 
-    async def __calculate_sma_slope(self, symbol, timerange):
+    async def __calculate_sma_slope(self, symbol, timerange, full=False):
         sma_slope = 0
-        df = await self.data.get_data_for_pair(symbol, timerange, 20)
-        df_resample = self.data.resample_data(df, timerange)
+        if not full:
+            try:
+                stream = await self.__get_stream(symbol, timerange, "sma", 20)
+                sma_slope = stream.value() - stream.previous()
+                Indicators.logging.debug(f"SMA Slope: {sma_slope}")
+            except:
+                sma_slope = ""
 
-        try:
-            # Calculate the SMA
-            df_resample["sma"] = talib.SMA(df_resample, length=20)
+            return sma_slope
 
-            # Calculate the SMA slope
-            df_resample["sma_slope"] = df_resample[
-                "sma"
-            ].diff()  # Calculate the difference between consecutive SMA values
+        df_resample = await self.data.get_resampled_data(symbol, timerange, 20)
 
-            sma_slope = df_resample["sma_slope"].dropna().iloc[-1]
+        try:
+            sma_slope = await self.__sma_last_slope(df_resample, 20)
 
             Indicators.logging.debug(f"SMA Slope: {sma_slope}")
         except:
@@ -220,8 +294,8 @@ class Indicators:
 
         return sma_slope
 
-    async def categorize_sma_slope(self, symbol, timerange):
-        slope = await self.__calculate_sma_slope(symbol, timerange)
+    async def categorize_sma_slope(self, symbol, timerange, full=False):
+        slope = await self.__calculate_sma_slope(symbol, timerange, full)
         categories = ""
         if slope:
             if slope > 0:
@@ -235,11 +309,19 @@ class Indicators:
 
         return sma_slope
 
-    async def calculate_sma(self, symbol, timerange):
-        df = await self.data.get_data_for_pair(symbol, timerange, 20)
-        df_resample = self.data.resample_data(df, timerange)
+    async def calculate_sma(self, symbol, timerange, full=False):
+        try:
+            if not full:
+                stream = await self.__get_stream(symbol, timerange, "sma", 20)
+                sma = stream.value()
+                if sma is None:
+                    sma = ""
+            else:
+                df_resample = await self.data.get_resampled_data(symbol, timerange, 20)
+                sma = await self.__sma(df_resample, 20)
+        except:
+            sma = ""
 
-        sma = talib.SMA(df_resample, length=20).dropna().iloc[-1]
         return {"status": sma}
 
     async def get_stablecoin_dominance(self):
@@ -253,11 +335,9 @@ class Indicators:
                 date__gt=begin_week, indicator="stablecoin_dominance"
             ).values_list("value", flat=True)
             if len(global_data) >= 7:
-                days = np.arange(1, len(global_data) + 1)
-
                 # Linear Regression
-                slope, intercept, r_value, p_value, std_err = linregress(
-                    days, global_data
+                slope = await self.executor.run(
+                    calculations.trend_slope, np.asarray(global_data, dtype="float64")
                 )
                 trend = (
                     "uptrend" if slope > 0 else "downtrend" if slope < 0 else "neutral"
@@ -292,53 +372,173 @@ class Indicators:
             tolerance (float): The percentage tolerance to consider a price as being on a support level.
 
         Returns:
-            pd.DataFrame: The original DataFrame with a 'Support' column indicating if it's near a support level.
+            dict: status "True" if the last price is near a support level.
         """
+        levels = await self.calculate_levels(
+            symbol, timerange, num_levels, lookback, tolerance, merge_tolerance
+        )
+        if not levels["status"]:
+            return levels
 
-        # TODO - Calculate the length exactly for support levels
-        actual_df = await self.data.get_data_for_pair(symbol, timerange, 120)
-        df_resample = self.data.resample_data(actual_df, timerange)
-
-        df = df_resample.copy()
+        return {"status": f"{levels['status']['near_support']}"}
 
-        # Identify local minima over the specified lookback window
-        df["Support_Level"] = df["low"][
-            (df["low"] == df["low"].rolling(window=lookback, center=True).min())
-        ]
+    async def calculate_levels(
+        self,
+        symbol,
+        timerange,
+        num_levels=5,
+        lookback=5,
+        tolerance=0.005,
+        merge_tolerance=0.025,
+    ):
+        """Support and resistance levels of the symbol with the last price."""
+        levels = ""
+        try:
+            levels = await self.levels.get_levels(
+                symbol, timerange, num_levels, lookback, tolerance, merge_tolerance
+            )
+            if levels is None:
+                Indicators.logging.info(
+                    f"Levels cannot be calculated for {symbol}@{timerange}: no data"
+                )
+                levels = ""
+        except Exception as e:
+            Indicators.logging.error(
+                f"Error calculating levels for {symbol}@{timerange}. Cause: {e}"
+            )
 
-        # Extract unique support levels and sort them
-        support_levels = sorted(df["Support_Level"].dropna().unique())
+        return {"status": levels}
+
+    def __batch_item(self, index, request, handlers):
+        """Validate one batch request - returns its key, the parsed item and an error."""
+        if not isinstance(request, dict):
+            return str(index), None, "request is not an object"
+
+        key = request.get("id")
+        if key is not None and not isinstance(key, str):
+            return str(index), None, "id is not a string"
+        fields = [request.get(name) for name in ("symbol", "timerange", "indicator")]
+        params = request.get("params", {})
+        if key is None:
+            key = ":".join(
+                [str(field) for field in fields]
+                + (
+                    [str(value) for value in params.values()]
+                    if isinstance(params, dict)
+                    else []
+                )
+            )
 
-        # Merge nearby support levels
-        merged_support_levels = []
-        if support_levels:
-            group = [support_levels[0]]  # Start with the first level
-            for level in support_levels[1:]:
-                # Check if the current level is within merge tolerance of the last level in the group
-                if level <= group[-1] * (1 + merge_tolerance):
-                    group.append(level)
-                else:
-                    # Add the average of the group to the merged levels
-                    merged_support_levels.append(sum(group) / len(group))
-                    group = [level]  # Start a new group
-            # Add the last group
-            merged_support_levels.append(sum(group) / len(group))
-
-        # Limit to the most recent `num_levels` merged support levels
-        merged_support_levels = merged_support_levels[-num_levels:]
-
-        # Get the last price
-        last_price = actual_df["close"].iloc[-1]
-
-        # Check if the last price is within tolerance of the most recent support level
-        is_near_support = False
-        for lvl in merged_support_levels:
-            lower_bound = lvl * (1 - tolerance)
-            upper_bound = lvl * (1 + tolerance)
-            Indicators.logging.debug(
-                f"Symbol: {symbol}, Merged Support Level: {lvl}, Range: {lower_bound} - {upper_bound}, Last Price: {last_price}"
+        if not all(isinstance(field, str) and field for field in fields):
+            return key, None, "symbol, timerange and indicator are required"
+        symbol, timerange, indicator = fields
+        if indicator not in handlers:
+            return key, None, f"unknown indicator {indicator}"
+        if not isinstance(params, dict):
+            return key, None, "params is not an object"
+        try:
+            params = {name: int(value) for name, value in params.items()}
+        except (TypeError, ValueError):
+            return key, None, "params must be integers"
+        try:
+            lookback = handlers[indicator][0](params)
+        except KeyError as e:
+            return key, None, f"missing param {e.args[0]}"
+        if lookback <= 0:
+            return key, None, "params must be positive"
+
+        return key, (symbol, timerange, indicator, params, lookback), None
+
+    async def calculate_batch(self, requests):
+        """Calculate many indicators for many symbols in one go.
+
+        Parameters
+        ----------
+        requests: list
+            List of {"symbol", "timerange", "indicator", "params", "id"(optional)}
+
+        Returns
+        -------
+        dict
+            Indicator values by request id (or symbol:timerange:indicator:params),
+            invalid requests have an empty value and their error in "errors"
+        """
+        handlers = {
+            "rsi": (
+                lambda p: p["length"],
+                lambda df, p, symbol, timerange: self.__rsi(df, p["length"]),
+            ),
+            "ema": (
+                lambda p: p["length"],
+                lambda df, p, symbol, timerange: self.__ema(df, p["length"]),
+            ),
+            "ema_slope": (
+                lambda p: p["length"],
+                lambda df, p, symbol, timerange: self.__ema_slope(df, p["length"]),
+            ),
+            "ema_distance": (
+                lambda p: p["length"],
+                lambda df, p, symbol, timerange: self.__ema_distance(df, p["length"]),
+            ),
+            "ema_cross": (
+                lambda p: 21,
+                lambda df, p, symbol, timerange: self.__ema_cross(df),
+            ),
+            "price_action": (
+                lambda p: p["length"],
+                lambda df, p, symbol, timerange: self.__price_action(df, p["length"]),
+            ),
+            "sma": (lambda p: 20, lambda df, p, symbol, timerange: self.__sma(df, 20)),
+            "sma_slope": (
+                lambda p: 20,
+                lambda df, p, symbol, timerange: self.__sma_slope(df, 20),
+            ),
+            "support": (
+                # The levels fetch their own history
+                lambda p: 1,
+                lambda df, p, symbol, timerange: self.__support(
+                    symbol, timerange, p.get("numlevels", 5)
+                ),
+            ),
+        }
+
+        # Group the requests, so every (symbol, timerange) is fetched and resampled once
+        groups = {}
+        result = {}
+        errors = {}
+        for index, request in enumerate(requests):
+            key, item, error = self.__batch_item(index, request, handlers)
+            if error is not None:
+                Indicators.logging.error(f"Invalid batch request {key}: {error}")
+                result[key] = ""
+                errors[key] = error
+                continue
+            symbol, timerange, indicator, params, lookback = item
+            groups.setdefault((symbol, timerange), []).append(
+                (key, indicator, params, lookback)
             )
-            if lower_bound <= last_price <= upper_bound:
-                is_near_support = True
 
-        return {"status": f"{is_near_support}"}
+        for (symbol, timerange), group in groups.items():
+            df = None
+            try:
+                lookback = max(lookback for key, indicator, params, lookback in group)
+                df = await self.data.get_resampled_data(symbol, timerange, lookback)
+            except Exception as e:
+                Indicators.logging.error(
+                    f"Error getting batch data for {symbol}@{timerange}. Cause: {e}"
+                )
+
+            for key, indicator, params, lookback in group:
+                try:
+                    result[key] = await handlers[indicator][1](
+                        df, params, symbol, timerange
+                    )
+                except Exception as e:
+                    Indicators.logging.info(
+                        f"{indicator} cannot be calculated for {symbol}@{timerange}: {e}"
+                    )
+                    result[key] = ""
+
+        if errors:
+            return {"result": result, "errors": errors}
+        return {"result": result}
@@ -0,0 +1,147 @@
+import calculations
+import numpy as np
+
+from data import Data
+from logger import LoggerFactory
+
+
+class Levels:
+    """Support and resistance levels per (symbol, timerange).
+
+    Pivots (local minima of the lows and maxima of the highs) are kept with
+    the timestamp of their bucket. A pivot is final once its window only
+    contains completed buckets, so after a closed candle just the trailing
+    window is evaluated again. Pivots falling out of the lookback are
+    dropped and the remaining ones are clustered into levels.
+    """
+
+    # Pivot state per (symbol, timerange, lookback)
+    cache = {}
+    stats = {"hits": 0, "incremental": 0, "full": 0}
+    # Length of the resampled history the pivots are searched in
+    history = 120
+
+    def __init__(self, loglevel):
+        self.data = Data(loglevel)
+        self.data.add_candle_listener(self.update)
+
+        Levels.logging = LoggerFactory.get_logger(
+            "logs/levels.log", "levels", log_level=loglevel
+        )
+        Levels.logging.info("Initialized")
+
+    def update(self, pair, candle):
+        """Mark the levels of the pair as outdated - drop them if its candles got reset."""
+        for key in [key for key in Levels.cache if key[0] == pair]:
+            if candle is None:
+                del Levels.cache[key]
+            else:
+                Levels.cache[key]["dirty"] = True
+
+    def __pivots(self, timestamp, values, start, lookback, highs):
+        """Pivots from index start on as (timestamps, prices)."""
+        first = max(start - lookback // 2, 0)
+        indices = calculations.pivots(values[first:], lookback, highs=highs) + first
+        indices = indices[indices >= start]
+
+        return timestamp[indices], values[indices]
+
+    def __evaluate(self, df, lookback, state):
+        timestamp = df["timestamp"].to_numpy(dtype="float64")
+        offset = lookback // 2
+        # Pivots before boundary don't depend on the last (running) bucket anymore
+        boundary = len(timestamp) - lookback + offset
+        start = offset
+        if state is not None and state["until"] is not None:
+            position = np.searchsorted(timestamp, state["until"])
+            if position < len(timestamp) and timestamp[position] == state["until"]:
+                start = max(position + 1, offset)
+                Levels.stats["incremental"] += 1
+            else:
+                state = None
+        else:
+            state = None
+        if state is None:
+            Levels.stats["full"] += 1
+
+        result = {
+            "dirty": False,
+            "until": timestamp[boundary - 1] if boundary > offset else None,
+            "price": float(df["close"].iloc[-1]),
+            "levels": {},
+        }
+        pivots = {}
+        for side, column, highs in (("lows", "low", False), ("highs", "high", True)):
+            values = df[column].to_numpy(dtype="float64")
+            times, prices = self.__pivots(timestamp, values, start, lookback, highs)
+            if state is not None:
+                # Keep the final pivots which are still in the lookback
+                keep = state[side][0] >= timestamp[offset]
+                times = np.concatenate([state[side][0][keep], times])
+                prices = np.concatenate([state[side][1][keep], prices])
+            final = times <= (result["until"] if result["until"] is not None else -1)
+            result[side] = (times[final], prices[final])
+            pivots[side] = prices
+
+        result["pivots"] = pivots
+
+        return result
+
+    def __levels(self, state, merge_tolerance):
+        if merge_tolerance not in state["levels"]:
+            state["levels"][merge_tolerance] = (
+                calculations.cluster_levels(state["pivots"]["lows"], merge_tolerance),
+                calculations.cluster_levels(state["pivots"]["highs"], merge_tolerance),
+            )
+
+        return state["levels"][merge_tolerance]
+
+    async def get_levels(
+        self,
+        symbol,
+        timerange,
+        num_levels=5,
+        lookback=5,
+        tolerance=0.005,
+        merge_tolerance=0.025,
+    ):
+        """Support and resistance levels with the last price, None without data.
+
+        The highest num_levels support and the lowest num_levels resistance
+        levels are returned, near_* is True if the last price is within
+        tolerance of one of them.
+        """
+        key = (symbol, timerange, lookback)
+        state = Levels.cache.get(key)
+        if state is not None and not state["dirty"]:
+            Levels.stats["hits"] += 1
+        else:
+            df = await self.data.get_resampled_data(symbol, timerange, Levels.history)
+            if df is None or df.empty:
+                return None
+            state = self.__evaluate(df, lookback, state)
+            Levels.cache[key] = state
+
+        support, resistance = self.__levels(state, merge_tolerance)
+        support = support[-num_levels:] if num_levels else support[:0]
+        resistance = resistance[:num_levels]
+        price = state["price"]
+
+        def near(levels):
+            return bool(
+                np.any(
+                    (levels * (1 - tolerance) <= price)
+                    & (price <= levels * (1 + tolerance))
+                )
+            )
+
+        return {
+            "price": price,
+            "support": [float(level) for level in support],
+            "resistance": [float(level) for level in resistance],
+            "near_support": near(support),
+            "near_resistance": near(resistance),
+        }
+
+    def get_stats(self):
+        return {**Levels.stats, "size": len(Levels.cache)}
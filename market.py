@@ -1,11 +1,19 @@
 import ccxt.pro as ccxtpro
 import ccxt as ccxt
 import asyncio
-import json
+import contextvars
+import itertools
+import sys
+import time
 
 from logger import LoggerFactory
-from models import Tickers, Symbols
+from models import Tickers
+from backfill import Backfill
+from candles import native_key, timerange_to_ms
 from data import Data
+from metrics import Metrics
+from registry import SymbolRegistry
+from writer import Writer
 
 
 class Market:
@@ -20,32 +28,83 @@ class Market:
         loglevel,
         timeframe,
         history_data,
+        write_batch_size=500,
+        write_flush_interval=1,
+        backfill_concurrency=4,
+        timeframes=None,
+        shard_size=200,
     ):
         self.currency = currency
         self.timeframe = timeframe
+        # The configured timeframe first, then the natively subscribed higher ones
+        self.timeframes = [timeframe] + [
+            item for item in timeframes or [] if item and item != timeframe
+        ]
         self.history_data = history_data
         self.data = Data(loglevel)
-        Market.exchange_class = getattr(ccxtpro, exchange)
-        Market.exchange = Market.exchange_class(
-            {
-                "apiKey": key,
-                "secret": secret,
-                "options": {
-                    "defaultType": market,
-                },
+        self.metrics = Metrics()
+        self.registry = SymbolRegistry(loglevel)
+        self.writer = Writer(
+            loglevel, batch_size=write_batch_size, flush_interval=write_flush_interval
+        )
+        # Streams (symbol and timeframe) per websocket connection
+        self.shard_size = int(shard_size)
+        self.exchange_config = {
+            "apiKey": key,
+            "secret": secret,
+            "options": {
+                "defaultType": market,
             },
+        }
+        Market.exchange_class = getattr(ccxtpro, exchange)
+        # Used for the REST calls - every shard opens its own exchange
+        Market.exchange = Market.exchange_class(self.exchange_config)
+        invalid = self.__invalid_timeframes()
+        if invalid:
+            sys.tracebacklimit = 0
+            sys.exit(
+                f"Timeframes {', '.join(invalid)} are not supported - they need a fixed length (no 1w or 1M) and have to be offered by {exchange}."
+            )
+
+        self.backfill = Backfill(
+            loglevel,
+            Market.exchange,
+            timeframe,
+            history_data,
+            self.data,
+            backfill_concurrency,
         )
 
         # Class variables
         Market.status = True
         Market.symbols = []
+        # {shard_id: {"streams", "task", "exchange", "status", ...}}
+        Market.shards = {}
+        Market.shard_ids = itertools.count()
+        # Maximum seconds a failing shard waits until it reconnects
+        Market.backoff_max = 60
         Market.logging = LoggerFactory.get_logger(
             "logs/market.log", "market", log_level=loglevel
         )
         Market.logging.info("Initialized")
 
+    def __invalid_timeframes(self) -> list:
+        """Configured timeframes which can't be bucketed or aren't offered by the exchange."""
+        offered = getattr(Market.exchange, "timeframes", None) or {}
+        invalid = []
+        for timeframe in self.timeframes:
+            try:
+                timerange_to_ms(timeframe)
+            except ValueError:
+                invalid.append(timeframe)
+                continue
+            if offered and timeframe not in offered:
+                invalid.append(timeframe)
+
+        return invalid
+
     def __convert_symbols(self, symbols: list) -> list:
-        """Add the configured timestamp to the Symbol array
+        """Add the configured timeframes to the Symbol array
 
         Parameters
         ----------
@@ -55,232 +114,356 @@ class Market:
         Returns
         -------
         list
-            List of symbols with timestamps
+            List of symbols with timeframes
         """
         symbol_list = []
         if symbols:
             for symbol in symbols:
-                symbol_list.append([symbol, self.timeframe])
+                for timeframe in self.timeframes:
+                    symbol_list.append([symbol, timeframe])
         else:
             Market.logging.error("Symbol list is empty!")
 
         return symbol_list
 
-    async def __get_historical_data(self, symbol):
-        ohlcv = []
-        try:
-            from_ts = self.exchange.parse8601(self.history_data)
-            ohlcv_data = await self.exchange.fetch_ohlcv(
-                symbol, self.timeframe, since=from_ts, limit=1000
-            )
-            while True:
-                from_ts = ohlcv_data[-1][0]
-                new_ohlcv = await self.exchange.fetch_ohlcv(
-                    symbol, self.timeframe, since=from_ts, limit=1000
-                )
-                ohlcv_data.extend(new_ohlcv)
-                if len(new_ohlcv) != 1000:
-                    break
-            symbol, market = symbol.split("/")
-
-            for ticker in ohlcv_data:
-                ticker = Tickers(
-                    timestamp=ticker[0],
-                    symbol=symbol + market,
-                    open=ticker[1],
-                    high=ticker[2],
-                    low=ticker[3],
-                    close=ticker[4],
-                    volume=ticker[5],
-                )
-                ohlcv.append(ticker)
-            return ohlcv
-        except ccxt.NetworkError as e:
-            Market.logging.error(
-                f"Error fetching historical data from Exchange due to a network error: {e}"
-            )
-        except ccxt.ExchangeError as e:
-            Market.logging.error(
-                f"Error fetching historical data from Exchange due to an exchange error: {e}"
-            )
-        except Exception as e:
-            Market.logging.error(
-                f"Error fetching historical data from Exchange. Cause: {e}"
-            )
-
     async def add_symbol(self, symbol) -> bool:
         """Adding new symbol to the ticker list."""
-        symbol_list = []
-        symbols = await self.data.get_symbols()
-        ohlcv = []
-
-        if symbols:
-            for ticker in symbols:
-                symbol_list.append(ticker)
-
-        if symbol not in symbol_list:
-            try:
-                # add initial historic data into database
-                ohlcv = await self.__get_historical_data(symbol)
-                # Write history data to database
-                await self.__process_data(ohlcv, bulk=True)
-                # Add symbol to symbol table
-                await Symbols.create(symbol=symbol)
-                Market.logging.info(f"Added Symbol {symbol}.")
-                # Add symbol to websocket subscription
-                symbol_list.append(symbol)
-                Market.symbols = self.__convert_symbols(symbol_list)
-                return True
-            except Exception as e:
-                Market.logging.error(f"Error writing ticker data in to db: {e}")
-                return False
-        else:
+        if not self.registry.add(symbol):
             Market.logging.info("Symbol already on the list.")
             return False
 
-    async def status_symbols(self):
-        symbol_list = []
-        for symbol, timerange in Market.symbols:
-            symbol, market = symbol.split("/")
-            symbol_list.append(f"{symbol}{market}@{timerange}")
+        # Fetch the historic data in the background
+        self.backfill.start(symbol)
+        Market.logging.info(f"Added Symbol {symbol}.")
+
+        return True
 
-        return json.dumps(symbol_list)
+    async def status_symbols(self) -> list:
+        return [
+            f"{symbol.replace('/', '')}@{timerange}"
+            for symbol, timerange in Market.symbols
+        ]
 
     async def remove_symbol(self, symbol):
         """Remove new symbol to the ticker list."""
-        symbols = await self.data.get_symbols()
-        symbol_list = []
-
-        if symbols:
-            for ticker in symbols:
-                symbol_list.append(ticker)
-
-            if symbol in symbol_list:
-                symbol_list.remove(symbol)
-                Market.symbols = self.__convert_symbols(symbol_list)
-                try:
-                    query = await Symbols.filter(symbol=symbol).delete()
-                    symbol, currency = symbol.split("/")
-                    symbol = symbol + currency
-                    query = await Tickers.filter(symbol=symbol).delete()
-                    Market.logging.info(
-                        f"Start removing symbol. Deleted {query} entries for {symbol}"
-                    )
-                    return True
-                except Exception as e:
-                    Market.logging.error(f"Error removing symbol from database: {e}")
-                    return False
-            else:
-                Market.logging.info("Symbol not on the list.")
+        if not self.registry.get():
+            Market.logging.info("No initial Symbols yet - please add one.")
+            return False
 
+        if not self.registry.remove(symbol):
+            Market.logging.info("Symbol not on the list.")
             return False
-        else:
-            Market.logging.info("No initial Symbols yet - please add one.")
 
+        try:
+            # A running backfill would write the symbol again
+            await self.backfill.cancel(symbol)
+            symbol, currency = symbol.split("/")
+            symbol = symbol + currency
+            # Queued candles would be written after the delete
+            await self.writer.discard(
+                [symbol]
+                + [native_key(symbol, timeframe) for timeframe in self.timeframes[1:]]
+            )
+            self.data.remove_candles(symbol)
+            self.metrics.remove(symbol=symbol)
+            query = await self.data.store.delete(symbol)
+            for timeframe in self.timeframes[1:]:
+                query += await self.data.store.delete(native_key(symbol, timeframe))
+            Market.logging.info(
+                f"Start removing symbol. Deleted {query} entries for {symbol}"
+            )
+            return True
+        except Exception as e:
+            Market.logging.error(f"Error removing symbol from database: {e}")
             return False
 
-    async def __process_data(self, ohlcv, bulk=False):
+    async def __process_data(self, ohlcv, timeframe):
+        if not self.registry.contains(ohlcv["symbol"]):
+            # Late candle of a removed symbol - its data is deleted already
+            return
+
         try:
-            if bulk:
-                await Tickers.bulk_create(ohlcv)
-            else:
-                symbol, market = ohlcv["symbol"].split("/")
-                await Tickers.create(
+            symbol, market = ohlcv["symbol"].split("/")
+            pair = symbol + market
+            candle = [
+                ohlcv["timestamp"],
+                ohlcv["open"],
+                ohlcv["high"],
+                ohlcv["low"],
+                ohlcv["close"],
+                ohlcv["volume"],
+            ]
+            key = pair if timeframe == self.timeframe else native_key(pair, timeframe)
+            # Keep the in-memory candles up to date - the candle is stored anyway
+            try:
+                if timeframe == self.timeframe:
+                    self.data.add_candle(pair, candle)
+                else:
+                    self.data.add_native_candle(pair, timeframe, candle)
+            except Exception as e:
+                Market.logging.error(
+                    f"Error updating the candles of {key} in memory: {e}"
+                )
+            # Written in batches by the writer task
+            self.writer.enqueue(
+                Tickers(
                     timestamp=ohlcv["timestamp"],
-                    symbol=symbol + market,
+                    symbol=key,
                     open=ohlcv["open"],
                     high=ohlcv["high"],
                     low=ohlcv["low"],
                     close=ohlcv["close"],
                     volume=ohlcv["volume"],
                 )
+            )
         except Exception as e:
             Market.logging.error(f"Error writing ticker data in to db: {e}")
 
-    async def watch_tickers(self):
-        last_candles = {}
+    async def __process_ohlcvs(self, ohlcvs, last_candles) -> int:
+        """Process the closed candles of a watch_ohlcv_for_symbols result."""
+        closed = 0
+        for symbol, timeframes in ohlcvs.items():
+            for tf, ohlcv_list in timeframes.items():
+                self.metrics.inc(
+                    "moonloader_websocket_messages_total",
+                    symbol=symbol.replace("/", ""),
+                    timeframe=tf,
+                )
+                # Process the last candle from the list for the given symbol and timeframe
+                if ohlcv_list:
+                    current_candle = ohlcv_list[-1]
+                    timestamp, open, high, low, close, volume = current_candle
+                    # Check if it's a new candle for the current symbol and timeframe
+                    if (symbol, tf) in last_candles:
+                        if (
+                            last_candles[(symbol, tf)] is None
+                            or last_candles[(symbol, tf)][0] < timestamp
+                        ):
+                            # The previous candle for this symbol has closed; write it to the database
+                            if last_candles[(symbol, tf)]:
+                                (
+                                    timestamp,
+                                    open,
+                                    high,
+                                    low,
+                                    close,
+                                    volume,
+                                ) = last_candles[(symbol, tf)]
+                                ohlcv = {
+                                    "timestamp": timestamp,
+                                    "symbol": symbol,
+                                    "open": open,
+                                    "high": high,
+                                    "low": low,
+                                    "close": close,
+                                    "volume": volume,
+                                }
+                                await self.__process_data(ohlcv, tf)
+                                Market.logging.debug(ohlcv)
+                                closed += 1
+                                # The candle closed at timestamp plus its timeframe
+                                close_time = (
+                                    timestamp + ccxt.Exchange.parse_timeframe(tf) * 1000
+                                )
+                                self.metrics.set(
+                                    "moonloader_candle_close_lag_seconds",
+                                    max(time.time() * 1000 - close_time, 0) / 1000,
+                                    symbol=symbol.replace("/", ""),
+                                    timeframe=tf,
+                                )
 
-        # Initial list for symbols in database
-        symbols = await self.data.get_symbols()
+                            last_candles[(symbol, tf)] = current_candle
 
-        if symbols:
-            Market.symbols = self.__convert_symbols(symbols)
-            # Track the last candle for each symbol
-            last_candles = {symbol: None for symbol in symbols}
-
-        actual_symbols = Market.symbols
-        while Market.status:
-            if Market.symbols:
-                # Reload on symbol list change
-                if Market.symbols == actual_symbols:
-                    ohlcvs = None
-                    try:
-                        ohlcvs = await Market.exchange.watch_ohlcv_for_symbols(
-                            Market.symbols
-                        )
-                    except ccxt.NetworkError as e:
+        return closed
+
+    async def __unwatch(self, shard_id, exchange, streams):
+        """Unsubscribe removed streams if the exchange supports it."""
+        try:
+            await exchange.un_watch_ohlcv_for_symbols(streams)
+        except Exception as e:
+            # Not supported by every exchange - the stream just gets ignored then
+            Market.logging.debug(f"Cannot unsubscribe in shard {shard_id}: {e}")
+
+    async def __watch_shard(self, shard_id, shard, last_candles):
+        """Watch the streams of a shard on its own connection with its own backoff.
+
+        The stream list is read on every call, so changed streams are
+        (un)subscribed on the open connection with the next update.
+        """
+        exchange = shard["exchange"] = Market.exchange_class(self.exchange_config)
+        delay = 0
+        try:
+            while Market.status:
+                if shard["removed"]:
+                    removed, shard["removed"] = shard["removed"], []
+                    await self.__unwatch(
+                        shard_id, exchange, [list(stream) for stream in removed]
+                    )
+                try:
+                    ohlcvs = await exchange.watch_ohlcv_for_symbols(
+                        [list(stream) for stream in shard["streams"]]
+                    )
+                except Exception as e:
+                    if isinstance(e, ccxt.NetworkError):
                         Market.logging.error(
-                            f"Error watching websocket data from Exchange due to a network error: {e}"
+                            f"Error watching websocket data of shard {shard_id} from Exchange due to a network error: {e}"
                         )
-                        continue
-                    except ccxt.ExchangeError as e:
+                    elif isinstance(e, ccxt.ExchangeError):
                         Market.logging.error(
-                            f"Error watching websocket data from Exchange due to an exchange error: {e}"
+                            f"Error watching websocket data of shard {shard_id} from Exchange due to an exchange error: {e}"
                         )
-                        continue
-                    except Exception as e:
-                        Market.logging.error(f"CCXT websocket error. Cause: {e}")
-                        continue
-                    if ohlcvs:
-                        for symbol, timeframes in ohlcvs.items():
-                            for tf, ohlcv_list in timeframes.items():
-                                # Process the last candle from the list for the given symbol and timeframe
-                                if ohlcv_list:
-                                    current_candle = ohlcv_list[-1]
-                                    timestamp, open, high, low, close, volume = (
-                                        current_candle
-                                    )
-                                    # Check if it's a new candle for the current symbol
-                                    if symbol in last_candles:
-                                        if (
-                                            last_candles[symbol] is None
-                                            or last_candles[symbol][0] < timestamp
-                                        ):
-                                            # The previous candle for this symbol has closed; write it to the database
-                                            if last_candles[symbol]:
-                                                (
-                                                    timestamp,
-                                                    open,
-                                                    high,
-                                                    low,
-                                                    close,
-                                                    volume,
-                                                ) = last_candles[symbol]
-                                                ohlcv = {
-                                                    "timestamp": timestamp,
-                                                    "symbol": symbol,
-                                                    "open": open,
-                                                    "high": high,
-                                                    "low": low,
-                                                    "close": close,
-                                                    "volume": volume,
-                                                }
-                                                await self.__process_data(ohlcv)
-                                                Market.logging.debug(ohlcv)
-
-                                            last_candles[symbol] = current_candle
-                                    # Add new initial symbol for candle
-                                    else:
-                                        last_candles[symbol] = None
                     else:
-                        self.logging.error("OHLCV data empty")
-                else:
-                    actual_symbols = Market.symbols
-                    Market.logging.info(f"Actual symbol list: {actual_symbols}")
+                        Market.logging.error(
+                            f"CCXT websocket error in shard {shard_id}. Cause: {e}"
+                        )
+                    shard["errors"] += 1
+                    shard["last_error"] = str(e)
+                    # Exponential backoff - only this shard waits
+                    delay = min(max(delay * 2, 1), Market.backoff_max)
+                    shard["status"] = "backoff"
+                    await asyncio.sleep(delay)
                     continue
-            else:
-                await asyncio.sleep(5)
+
+                delay = 0
+                shard["status"] = "watching"
+                if ohlcvs:
+                    shard["candles"] += await self.__process_ohlcvs(
+                        ohlcvs, last_candles
+                    )
+                else:
+                    Market.logging.error(f"OHLCV data of shard {shard_id} empty")
+        finally:
+            try:
+                await exchange.close()
+            except Exception as e:
+                Market.logging.error(f"Error closing shard {shard_id}. Cause: {e}")
+
+    def __reshard(self, streams, last_candles):
+        """Assign the streams to shards of at most shard_size streams.
+
+        Streams keep their shard and the shards keep their connection - only
+        the added and removed streams get (un)subscribed.
+        """
+        wanted = [tuple(stream) for stream in streams]
+        keep = set(wanted)
+        assignment = {
+            shard_id: [stream for stream in shard["streams"] if stream in keep]
+            for shard_id, shard in Market.shards.items()
+        }
+        assigned = {stream for shard in assignment.values() for stream in shard}
+        for stream in wanted:
+            if stream in assigned:
+                continue
+            shard_id = next(
+                (
+                    shard_id
+                    for shard_id, shard in assignment.items()
+                    if len(shard) < self.shard_size
+                ),
+                None,
+            )
+            if shard_id is None:
+                shard_id = next(Market.shard_ids)
+                assignment[shard_id] = []
+            assignment[shard_id].append(stream)
+            assigned.add(stream)
+            # The first candle seen of a new stream is the running one
+            last_candles[stream] = None
+
+        for stream in [stream for stream in last_candles if stream not in keep]:
+            del last_candles[stream]
+
+        for shard_id, shard_streams in assignment.items():
+            shard = Market.shards.get(shard_id)
+            if shard is None:
+                shard = Market.shards[shard_id] = {
+                    "streams": shard_streams,
+                    "removed": [],
+                    "status": "connecting",
+                    "candles": 0,
+                    "errors": 0,
+                    "last_error": None,
+                }
+                # A fresh context, so the shard isn't attributed to a request
+                shard["task"] = asyncio.create_task(
+                    self.__watch_shard(shard_id, shard, last_candles),
+                    context=contextvars.Context(),
+                )
+                Market.logging.info(
+                    f"Watching {len(shard_streams)} streams in shard {shard_id}"
+                )
+            elif not shard_streams:
+                shard["task"].cancel()
+                del Market.shards[shard_id]
+                Market.logging.info(f"Closed empty shard {shard_id}")
+            elif shard["streams"] != shard_streams:
+                shard["removed"] += [
+                    stream for stream in shard["streams"] if stream not in keep
+                ]
+                shard["streams"] = shard_streams
+                Market.logging.info(
+                    f"Watching {len(shard_streams)} streams in shard {shard_id}"
+                )
+
+    def get_shard_stats(self):
+        return {
+            "shard_size": self.shard_size,
+            "version": SymbolRegistry.version,
+            "registry": self.registry.get_stats(),
+            "shards": {
+                shard_id: {
+                    "streams": len(shard["streams"]),
+                    "status": shard["status"],
+                    "candles": shard["candles"],
+                    "errors": shard["errors"],
+                    "last_error": shard["last_error"],
+                }
+                for shard_id, shard in Market.shards.items()
+            },
+        }
+
+    async def watch_tickers(self):
+        """Keep the shards in sync with the symbol registry.
+
+        Every shard watches its streams on its own exchange connection, the
+        closed candles of all shards go into the same pipeline.
+        """
+        if not SymbolRegistry.loaded:
+            await self.registry.load()
+        # Last candle for each subscribed symbol and timeframe
+        last_candles = {}
+
+        version = None
+        try:
+            while Market.status:
+                if SymbolRegistry.version != version:
+                    version = SymbolRegistry.version
+                    Market.symbols = self.__convert_symbols(self.registry.get())
+                    Market.logging.info(
+                        f"Symbol list version {version}: {Market.symbols}"
+                    )
+                    self.__reshard(Market.symbols, last_candles)
+                await self.registry.wait(version, timeout=5)
+        finally:
+            for shard in Market.shards.values():
+                shard["task"].cancel()
+            Market.shards = {}
+
+    async def resume_backfill(self):
+        """Fetch the candles missed while moonloader was not running."""
+        for symbol in self.registry.get():
+            self.backfill.start(symbol)
 
     async def shutdown(self):
         Market.status = False
+        # Closes the exchange of every shard
+        shards = list(Market.shards.values())
+        for shard in shards:
+            shard["task"].cancel()
+        await asyncio.gather(
+            *[shard["task"] for shard in shards], return_exceptions=True
+        )
+        await self.backfill.shutdown()
+        await self.registry.shutdown()
+        await self.writer.shutdown()
         await Market.exchange.close()
@@ -0,0 +1,168 @@
+import asyncio
+import contextvars
+import math
+import time
+
+from contextlib import contextmanager
+
+# Name: (type, help)
+definitions = {
+    "moonloader_websocket_messages_total": (
+        "counter",
+        "Websocket candle updates received per symbol and timeframe",
+    ),
+    "moonloader_candle_close_lag_seconds": (
+        "gauge",
+        "Seconds between the close of the last candle and its processing",
+    ),
+    "moonloader_db_seconds": ("histogram", "Latency of the candle store operations"),
+    "moonloader_request_seconds": ("histogram", "Latency of the HTTP endpoints"),
+    "moonloader_request_stage_seconds": (
+        "histogram",
+        "Time spent per endpoint in fetching, resampling and computing",
+    ),
+    "moonloader_backfill_progress_percent": (
+        "gauge",
+        "Progress of the last backfill job per symbol",
+    ),
+    "moonloader_backfill_candles": (
+        "gauge",
+        "Candles written by the last backfill job per symbol",
+    ),
+    "moonloader_event_loop_lag_seconds": (
+        "histogram",
+        "Delay of the event loop in waking up a sleeping task",
+    ),
+}
+
+
+class Metrics:
+    """Counters, gauges and histograms exposed in the Prometheus text format.
+
+    Values are kept per label set in class variables, so every instance
+    records into the same series. Collectors are called before rendering
+    to update the gauges derived from other state.
+    """
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    # Samples per series per sorted label tuple
+    values = {}
+    collectors = {}
+    status = True
+    # Endpoint of the running request - the stages of background work don't count
+    endpoint = contextvars.ContextVar("endpoint", default=None)
+
+    def __series(self, name, labels):
+        return Metrics.values.setdefault(name, {}), tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        series, key = self.__series(name, labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        series, key = self.__series(name, labels)
+        series[key] = value
+
+    def observe(self, name, value, **labels):
+        series, key = self.__series(name, labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = {
+                "buckets": [0] * len(Metrics.buckets),
+                "sum": 0.0,
+                "count": 0,
+            }
+        for index, bound in enumerate(Metrics.buckets):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def stage(self, stage, seconds):
+        """Attribute seconds of a stage (fetch, resample, compute) to the running request."""
+        endpoint = Metrics.endpoint.get()
+        if endpoint is not None:
+            self.observe(
+                "moonloader_request_stage_seconds",
+                seconds,
+                endpoint=endpoint,
+                stage=stage,
+            )
+
+    @contextmanager
+    def time(self, name, stage=None, **labels):
+        """Observe the duration of the block in the histogram (and the stage)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(name, seconds, **labels)
+            if stage is not None:
+                self.stage(stage, seconds)
+
+    def remove(self, **labels):
+        """Drop the samples of every series having all of the labels."""
+        labels = set(labels.items())
+        for series in Metrics.values.values():
+            for key in [key for key in series if labels <= set(key)]:
+                del series[key]
+
+    def add_collector(self, name, callback):
+        Metrics.collectors[name] = callback
+
+    def __labels(self, key, extra=()):
+        labels = [*key, *extra]
+        if not labels:
+            return ""
+        escaped = [
+            (
+                name,
+                str(value)
+                .replace("\\", r"\\")
+                .replace('"', r"\"")
+                .replace("\n", r"\n"),
+            )
+            for name, value in labels
+        ]
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def __number(self, value):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(float(value))
+
+    def render(self) -> str:
+        for callback in list(Metrics.collectors.values()):
+            callback(self)
+
+        lines = []
+        for name, (kind, help) in definitions.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in Metrics.values.get(name, {}).items():
+                if kind != "histogram":
+                    lines.append(f"{name}{self.__labels(key)} {self.__number(value)}")
+                    continue
+                for bound, count in zip(Metrics.buckets, value["buckets"]):
+                    labels = self.__labels(key, [("le", self.__number(bound))])
+                    lines.append(f"{name}_bucket{labels} {count}")
+                labels = self.__labels(key, [("le", "+Inf")])
+                lines.append(f"{name}_bucket{labels} {value['count']}")
+                lines.append(f"{name}_sum{self.__labels(key)} {value['sum']!r}")
+                lines.append(f"{name}_count{self.__labels(key)} {value['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    async def watch_event_loop(self, interval=0.5):
+        """Measure how much later than requested a sleeping task wakes up."""
+        loop = asyncio.get_running_loop()
+        Metrics.status = True
+        while Metrics.status:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - start - interval, 0.0)
+            self.observe("moonloader_event_loop_lag_seconds", lag)
+
+    def shutdown(self):
+        Metrics.status = False
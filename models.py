@@ -3,7 +3,8 @@ from tortoise.models import Model
 
 
 class Tickers(Model):
-    timestamp = fields.TextField()
+    # Candle open time in milliseconds
+    timestamp = fields.BigIntField()
     symbol = fields.TextField()
     open = fields.FloatField()
     high = fields.FloatField()
@@ -11,6 +12,9 @@ class Tickers(Model):
     close = fields.FloatField()
     volume = fields.FloatField()
 
+    class Meta:
+        indexes = (("symbol", "timestamp"),)
+
     def __dict__(self):
         return f"'id': {self.id}, 'timestamp': {self.timestamp}, 'symbol': {self.symbol}, 'open': {self.open}, 'high': {self.high},  'close': {self.close},  'volume': {self.volume}"
 
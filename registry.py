@@ -0,0 +1,136 @@
+import asyncio
+
+from logger import LoggerFactory
+from models import Symbols
+from tenacity import retry, stop_after_attempt, wait_fixed
+
+
+class SymbolRegistry:
+    """In-memory list of the subscribed symbols (format BTC/USDT).
+
+    Loaded once from the Symbols table. Every change bumps the version and
+    wakes up the waiting subscribers, the Symbols table is updated in the
+    background by the run task. A change which can't be persisted is kept
+    and retried before the later ones, so the table ends up in the same
+    order of changes.
+    """
+
+    symbols = {}
+    version = 0
+    loaded = False
+    retry_interval = 5
+
+    def __init__(self, loglevel):
+        # Class variables
+        SymbolRegistry.status = True
+        SymbolRegistry.changed = asyncio.Event()
+        SymbolRegistry.queue = asyncio.Queue()
+        # Change whose persistence failed - retried before the queued ones
+        SymbolRegistry.pending = None
+        SymbolRegistry.stats = {"persisted": 0, "errors": 0, "last_error": None}
+        SymbolRegistry.logging = LoggerFactory.get_logger(
+            "logs/market.log", "registry", log_level=loglevel
+        )
+
+    async def load(self):
+        symbols = await Symbols.all().distinct().values_list("symbol", flat=True)
+        SymbolRegistry.symbols = dict.fromkeys(symbols)
+        SymbolRegistry.loaded = True
+        self.__changed()
+        SymbolRegistry.logging.info(f"Loaded {len(symbols)} symbols")
+
+    def __changed(self):
+        SymbolRegistry.version += 1
+        SymbolRegistry.changed.set()
+
+    def get(self) -> list:
+        return list(SymbolRegistry.symbols)
+
+    def contains(self, symbol) -> bool:
+        return symbol in SymbolRegistry.symbols
+
+    def add(self, symbol) -> bool:
+        """Add the symbol - False if it is already registered."""
+        if symbol in SymbolRegistry.symbols:
+            return False
+
+        SymbolRegistry.symbols[symbol] = None
+        SymbolRegistry.queue.put_nowait(("add", symbol))
+        self.__changed()
+
+        return True
+
+    def remove(self, symbol) -> bool:
+        """Remove the symbol - False if it isn't registered."""
+        if symbol not in SymbolRegistry.symbols:
+            return False
+
+        del SymbolRegistry.symbols[symbol]
+        SymbolRegistry.queue.put_nowait(("remove", symbol))
+        self.__changed()
+
+        return True
+
+    def get_stats(self):
+        return {
+            **SymbolRegistry.stats,
+            # Changes not in the Symbols table yet - lost on a crash
+            "unpersisted": SymbolRegistry.queue.qsize()
+            + (SymbolRegistry.pending is not None),
+        }
+
+    async def wait(self, version, timeout=None) -> int:
+        """Wait until the version differs from the given one (or the timeout passed)."""
+        while SymbolRegistry.version == version:
+            SymbolRegistry.changed.clear()
+            try:
+                await asyncio.wait_for(SymbolRegistry.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+        return SymbolRegistry.version
+
+    @retry(wait=wait_fixed(1), stop=stop_after_attempt(5), reraise=True)
+    async def __persist(self, action, symbol):
+        if action == "add":
+            if not await Symbols.filter(symbol=symbol).exists():
+                await Symbols.create(symbol=symbol)
+        else:
+            await Symbols.filter(symbol=symbol).delete()
+
+    async def __apply(self, action, symbol) -> bool:
+        try:
+            await self.__persist(action, symbol)
+        except Exception as e:
+            SymbolRegistry.pending = (action, symbol)
+            SymbolRegistry.stats["errors"] += 1
+            SymbolRegistry.stats["last_error"] = f"{action} {symbol}: {e}"
+            SymbolRegistry.logging.error(
+                f"Error persisting {action} of {symbol}. Cause: {e}"
+            )
+            return False
+
+        SymbolRegistry.pending = None
+        SymbolRegistry.stats["persisted"] += 1
+        return True
+
+    async def run(self):
+        while SymbolRegistry.status:
+            if SymbolRegistry.pending is not None:
+                await asyncio.sleep(SymbolRegistry.retry_interval)
+                if not SymbolRegistry.status:
+                    # Persisted by shutdown
+                    break
+                change, SymbolRegistry.pending = SymbolRegistry.pending, None
+                await self.__apply(*change)
+                continue
+
+            await self.__apply(*await SymbolRegistry.queue.get())
+
+    async def shutdown(self):
+        SymbolRegistry.status = False
+        changes = [SymbolRegistry.pending] if SymbolRegistry.pending else []
+        while not SymbolRegistry.queue.empty():
+            changes.append(SymbolRegistry.queue.get_nowait())
+        for action, symbol in changes:
+            await self.__apply(action, symbol)
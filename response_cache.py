@@ -0,0 +1,159 @@
+import hashlib
+
+from datetime import datetime, timezone
+from candles import timerange_to_ms
+from collections import OrderedDict
+from data import Data
+from functools import wraps
+from logger import LoggerFactory
+from quart import Response, make_response, request
+from quart.wrappers.response import DataBody
+from rollups import Rollups
+from store import Store
+
+
+class ResponseCache:
+    """Responses of GET routes which only change with a new candle of a symbol.
+
+    Entries are kept per path, query string and Accept header together with
+    the version they were calculated for: the timestamp of the last candle
+    of the symbol in memory, the revision of its stored candles, the last
+    native candle of the timerange and a generation bumped by every
+    eviction. A closed candle (or a reset of the candles) evicts the
+    entries of its symbol. Responses carry an ETag of the body and the time
+    the body last changed, so polling clients get a 304 until the next
+    candle changes the response.
+    """
+
+    # Entries per (path, accept) in LRU order
+    entries = OrderedDict()
+    # Keys of the entries per symbol
+    pairs = {}
+    # Evictions per symbol
+    generations = {}
+    size = 4096
+    stats = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0}
+
+    def __init__(self, loglevel, size=None):
+        if size:
+            ResponseCache.size = int(size)
+        self.data = Data(loglevel)
+        self.data.add_candle_listener(self.evict)
+
+        ResponseCache.logging = LoggerFactory.get_logger(
+            "logs/data.log", "response_cache", log_level=loglevel
+        )
+        ResponseCache.logging.info("Initialized")
+
+    def evict(self, pair, candle):
+        # The entries stay until they are recalculated to keep their Last-Modified
+        ResponseCache.generations[pair] = ResponseCache.generations.get(pair, 0) + 1
+        ResponseCache.stats["evictions"] += len(ResponseCache.pairs.get(pair, ()))
+
+    def __version(self, pair, timerange):
+        """Version of the candles of the pair - None without candles."""
+        last = Data.freshness.get(pair)
+        if last is None:
+            return None
+        native = None
+        if timerange:
+            try:
+                native = Rollups.sealed.get((pair, timerange_to_ms(timerange)))
+            except ValueError:
+                pass
+
+        return "-".join(
+            str(part)
+            for part in (
+                last,
+                Store.revisions.get(pair),
+                native,
+                ResponseCache.generations.get(pair, 0),
+            )
+        )
+
+    def __store(self, key, entry):
+        ResponseCache.entries[key] = entry
+        ResponseCache.pairs.setdefault(entry["pair"], set()).add(key)
+        while len(ResponseCache.entries) > ResponseCache.size:
+            key, entry = ResponseCache.entries.popitem(last=False)
+            ResponseCache.pairs.get(entry["pair"], set()).discard(key)
+
+    def __not_modified(self, entry):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(entry["etag"])
+        since = request.if_modified_since
+        return since is not None and since >= entry["last_modified"]
+
+    def __headers(self, response, entry):
+        response.set_etag(entry["etag"])
+        response.last_modified = entry["last_modified"]
+        # Clients may keep the response but have to revalidate it
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["Vary"] = "Accept"
+
+        return response
+
+    def cached(self, pair=None):
+        """Cache a route by the candles of pair - the symbol argument by default."""
+
+        def decorator(route):
+            @wraps(route)
+            async def wrapper(*args, **kwargs):
+                symbol = pair or kwargs["symbol"]
+                version = self.__version(symbol, kwargs.get("timerange"))
+                if version is None:
+                    return await route(*args, **kwargs)
+
+                key = (request.full_path, request.headers.get("Accept"))
+                previous = entry = ResponseCache.entries.get(key)
+                if entry is not None and entry["version"] == version:
+                    ResponseCache.stats["hits"] += 1
+                    ResponseCache.entries.move_to_end(key)
+                else:
+                    ResponseCache.stats["misses"] += 1
+                    response = await make_response(await route(*args, **kwargs))
+                    # Errors and streamed bodies are passed through
+                    if response.status_code != 200 or not isinstance(
+                        response.response, DataBody
+                    ):
+                        return response
+                    body = await response.get_data()
+                    etag = hashlib.sha1(body).hexdigest()
+                    entry = {
+                        "pair": symbol,
+                        "version": version,
+                        "etag": etag,
+                        # An unchanged body keeps the time it was first calculated
+                        "last_modified": (
+                            previous["last_modified"]
+                            if previous is not None and previous["etag"] == etag
+                            else datetime.now(timezone.utc).replace(microsecond=0)
+                        ),
+                        "body": body,
+                        "headers": [
+                            (name, value)
+                            for name, value in response.headers.items()
+                            if name.lower() != "content-length"
+                        ],
+                    }
+                    self.__store(key, entry)
+
+                if self.__not_modified(entry):
+                    ResponseCache.stats["not_modified"] += 1
+                    return self.__headers(Response(b"", status=304), entry)
+
+                return self.__headers(
+                    Response(entry["body"], headers=entry["headers"]), entry
+                )
+
+            return wrapper
+
+        return decorator
+
+    def get_stats(self):
+        return {
+            **ResponseCache.stats,
+            "size": len(ResponseCache.entries),
+            "max_size": ResponseCache.size,
+        }
@@ -0,0 +1,239 @@
+import calculations
+import numpy as np
+import pandas as pd
+
+from candles import CandleBuffer, native_key, timerange_to_ms
+
+
+class Rollups:
+    """Higher timeframe candles, maintained with every closed base candle.
+
+    Each configured timerange of a symbol is kept as a CandleBuffer of
+    epoch aligned buckets. The buffers are built once from the candle store
+    and then updated in O(1) per closed candle, so reading a 1d series
+    doesn't resample the base candles again.
+
+    Timeframes subscribed natively at the exchange are kept the same way,
+    but every closed exchange candle replaces the bucket built from the base
+    candles, so they hold the exact exchange candles.
+    """
+
+    # {symbol: {timerange_ms: CandleBuffer}}
+    series = {}
+    # Timestamp of the last base candle applied per symbol
+    applied = {}
+    # Timestamp of the last native candle per (symbol, timerange_ms)
+    sealed = {}
+    timeranges = ("15min", "1h", "4h", "1d")
+    # Natively subscribed timeframes like 1h
+    native = ()
+    size = 1000
+
+    def __init__(self, timeranges=None, size=None, native=None):
+        if timeranges:
+            Rollups.timeranges = self.__parse(timeranges)
+        if native:
+            Rollups.native = self.__parse(native)
+        if size:
+            Rollups.size = int(size)
+
+    def __parse(self, timeranges) -> tuple:
+        if isinstance(timeranges, str):
+            timeranges = timeranges.split(",")
+        return tuple(timerange.strip() for timerange in timeranges if timerange.strip())
+
+    def __timeranges(self) -> dict:
+        """Rolled up and native timeranges by their length in ms."""
+        timeranges = {
+            timerange_to_ms(timerange): timerange for timerange in Rollups.timeranges
+        }
+        for timeframe in Rollups.native:
+            timeranges[timerange_to_ms(timeframe)] = timeframe
+
+        return timeranges
+
+    def __update(self, symbol, buffers, timestamp, open, high, low, close, volume):
+        for timerange_ms, buffer in buffers.items():
+            bucket = timestamp - timestamp % timerange_ms
+            if bucket <= Rollups.sealed.get((symbol, timerange_ms), -1):
+                # Already closed by the exchange
+                continue
+            last = buffer.last()
+            if last is not None and int(last[0]) == bucket:
+                buffer.append(
+                    bucket,
+                    last[1],
+                    max(last[2], high),
+                    min(last[3], low),
+                    close,
+                    last[5] + volume,
+                )
+            else:
+                buffer.append(bucket, open, high, low, close, volume)
+
+    def update(self, symbol, candle):
+        """Apply a closed base candle [timestamp, open, high, low, close, volume]."""
+        buffers = Rollups.series.get(symbol)
+        timestamp = int(candle[0])
+        if buffers is None or timestamp <= Rollups.applied.get(symbol, -1):
+            return
+
+        self.__update(
+            symbol, buffers, timestamp, *[float(value) for value in candle[1:]]
+        )
+        Rollups.applied[symbol] = timestamp
+
+    def update_native(self, symbol, timeframe, candle):
+        """Apply a closed exchange candle of a natively subscribed timeframe."""
+        timerange_ms = timerange_to_ms(timeframe)
+        buffer = Rollups.series.get(symbol, {}).get(timerange_ms)
+        timestamp = int(candle[0])
+        if buffer is None or timestamp <= Rollups.sealed.get(
+            (symbol, timerange_ms), -1
+        ):
+            return
+
+        values = [float(value) for value in candle[1:]]
+        # The base candles may have started the next bucket already
+        if buffer.append(timestamp, *values) or buffer.replace(timestamp, *values):
+            Rollups.sealed[(symbol, timerange_ms)] = timestamp
+
+    def __overlay(self, resampled, native):
+        """Replace the resampled buckets with the stored native candles."""
+        if not len(native["timestamp"]):
+            return resampled
+
+        keep = ~np.isin(resampled["timestamp"], native["timestamp"])
+        merged = {
+            column: np.concatenate(
+                [np.asarray(resampled[column])[keep], np.asarray(native[column])]
+            )
+            for column in CandleBuffer.columns
+        }
+        order = np.argsort(merged["timestamp"], kind="stable")
+
+        return {column: values[order] for column, values in merged.items()}
+
+    async def build(self, symbol, store, executor, candles=None):
+        """Build the rollups of the symbol from the stored history.
+
+        Timeranges the store keeps resampled (continuous aggregates) are
+        taken from there - if all are, the base candles aren't read at all.
+        Stored native candles replace the resampled buckets. Live candles of
+        the candle buffer which are newer than the stored history are applied
+        on top.
+        """
+        timeranges = self.__timeranges()
+        stored = {
+            timerange_ms: await store.read_resampled(symbol, timerange)
+            for timerange_ms, timerange in timeranges.items()
+        }
+        # The history is only read if a timerange has to be resampled here
+        columns = None
+        if any(resampled is None for resampled in stored.values()):
+            columns = await store.read(symbol)
+            last_timestamp = (
+                int(columns["timestamp"][-1]) if len(columns["timestamp"]) else -1
+            )
+        else:
+            last_timestamp = await store.last_timestamp(symbol)
+            if last_timestamp is None:
+                last_timestamp = -1
+
+        buffers = {}
+        for timerange_ms, timerange in timeranges.items():
+            resampled = stored[timerange_ms]
+            if resampled is None:
+                resampled = await executor.run(
+                    calculations.resample,
+                    np.asarray(columns["timestamp"], dtype=np.float64),
+                    np.asarray(columns["open"], dtype=np.float64),
+                    np.asarray(columns["high"], dtype=np.float64),
+                    np.asarray(columns["low"], dtype=np.float64),
+                    np.asarray(columns["close"], dtype=np.float64),
+                    np.asarray(columns["volume"], dtype=np.float64),
+                    timerange,
+                )
+                # Seconds to ms
+                resampled["timestamp"] = resampled["timestamp"] * 1000
+            Rollups.sealed.pop((symbol, timerange_ms), None)
+            if timerange in Rollups.native:
+                native = await store.recent(native_key(symbol, timerange), Rollups.size)
+                resampled = self.__overlay(resampled, native)
+                if len(native["timestamp"]):
+                    Rollups.sealed[(symbol, timerange_ms)] = int(
+                        native["timestamp"][-1]
+                    )
+            buffer = CandleBuffer(Rollups.size)
+            buffer.extend(
+                np.column_stack(
+                    [
+                        resampled["timestamp"],
+                        resampled["open"],
+                        resampled["high"],
+                        resampled["low"],
+                        resampled["close"],
+                        resampled["volume"],
+                    ]
+                )
+            )
+            buffers[timerange_ms] = buffer
+
+        Rollups.series[symbol] = buffers
+        Rollups.applied[symbol] = last_timestamp
+        if candles is not None:
+            for candle in zip(*candles.since(last_timestamp).values()):
+                self.update(symbol, candle)
+
+    def get(self, symbol, timerange, start_timestamp):
+        """Buckets of the timerange from the bucket containing start_timestamp (ms).
+
+        Returns None if the timerange isn't rolled up or doesn't reach back
+        far enough.
+        """
+        try:
+            timerange_ms = timerange_to_ms(timerange)
+        except ValueError:
+            return None
+        buffer = Rollups.series.get(symbol, {}).get(timerange_ms)
+        if buffer is None or not len(buffer):
+            return None
+
+        bucket = int(start_timestamp) - int(start_timestamp) % timerange_ms
+        if not buffer.covers(bucket):
+            return None
+
+        data = buffer.since(bucket - 1)
+        return pd.DataFrame(
+            {
+                # Seconds like the resampled data
+                "timestamp": data["timestamp"] / 1000,
+                "open": data["open"],
+                "high": data["high"],
+                "close": data["close"],
+                "low": data["low"],
+                "volume": data["volume"],
+            }
+        )
+
+    def remove(self, symbol):
+        Rollups.series.pop(symbol, None)
+        Rollups.applied.pop(symbol, None)
+        for key in [key for key in Rollups.sealed if key[0] == symbol]:
+            del Rollups.sealed[key]
+
+    def get_stats(self):
+        names = self.__timeranges()
+        return {
+            "timeranges": list(Rollups.timeranges),
+            "native": list(Rollups.native),
+            "size": Rollups.size,
+            # Number of buckets per symbol and timerange
+            "symbols": {
+                symbol: {
+                    names.get(timerange_ms, timerange_ms): len(buffer)
+                    for timerange_ms, buffer in buffers.items()
+                }
+                for symbol, buffers in Rollups.series.items()
+            },
+        }
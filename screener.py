@@ -0,0 +1,258 @@
+import ast
+import calculations
+import numpy as np
+
+from candles import timerange_to_ms
+from data import Data
+from logger import LoggerFactory
+
+
+class Screener:
+    """Indicators of all tracked symbols in one vectorized pass.
+
+    The closes of every symbol are aligned by bucket into one 2-D array per
+    timerange and all indicators are calculated at once in the executor.
+    Only closed buckets count, and symbols without a close in the newest
+    bucket are reported without values. All indicators share the lookback
+    of the longest length, so the RSI is warmed up over more candles than
+    by /indicators/rsi. The result of a timerange is cached until one of
+    its buckets closes, filter and sort expressions are applied on the
+    cached columns.
+    """
+
+    fields = ("close", "rsi", "ema_distance", "price_action", "slope")
+    # Columns per (timerange, rsi_length, ema_length, price_action_length)
+    cache = {}
+    stats = {"hits": 0, "misses": 0}
+    # Incremented with every closed bucket, so results started before aren't cached
+    generation = 0
+    # Length in ms per screened timerange
+    periods = {}
+
+    def __init__(self, loglevel, timeframe="1m"):
+        self.timeframe_ms = timerange_to_ms(timeframe)
+        self.data = Data(loglevel)
+        self.executor = self.data.executor
+        self.data.add_candle_listener(self.invalidate)
+
+        Screener.logging = LoggerFactory.get_logger(
+            "logs/screener.log", "screener", log_level=loglevel
+        )
+        Screener.logging.info("Initialized")
+
+    def invalidate(self, pair, candle):
+        if candle is None:
+            # The candles of the pair were reloaded or removed
+            Screener.generation += 1
+            Screener.cache.clear()
+            return
+
+        end = int(candle[0]) + self.timeframe_ms
+        closed = {
+            timerange
+            for timerange, period in Screener.periods.items()
+            if end % period == 0
+        }
+        if closed:
+            Screener.generation += 1
+            for key in [key for key in Screener.cache if key[0] in closed]:
+                del Screener.cache[key]
+
+    def __closed(self, pair, df, period):
+        """Only the buckets of the resampled candles which are complete."""
+        last = self.data.freshness.get(pair)
+        if last is None:
+            return df
+        timestamp = df["timestamp"].to_numpy(dtype="float64") * 1000
+
+        return df[timestamp + period <= last + self.timeframe_ms]
+
+    async def __align(self, timerange, lookback):
+        """Closes of all symbols as one array with a row per symbol and a column per bucket."""
+        symbols, series = [], []
+        period = Screener.periods[timerange]
+        for symbol in await self.data.get_symbols() or []:
+            pair = symbol.replace("/", "")
+            try:
+                df = await self.data.get_resampled_data(pair, timerange, lookback)
+                if df is not None:
+                    df = self.__closed(pair, df, period)
+            except Exception as e:
+                Screener.logging.error(
+                    f"Error getting data for {pair}@{timerange}. Cause: {e}"
+                )
+                continue
+            if df is None or df.empty:
+                continue
+            symbols.append(pair)
+            series.append(
+                (
+                    df["timestamp"].to_numpy(dtype="float64"),
+                    df["close"].to_numpy(dtype="float64"),
+                )
+            )
+
+        buckets = np.unique(
+            np.concatenate([timestamp for timestamp, close in series] or [[]])
+        )
+        close = np.full((len(series), len(buckets)), np.nan)
+        for row, (timestamp, values) in enumerate(series):
+            close[row, np.searchsorted(buckets, timestamp)] = values
+
+        return symbols, close
+
+    async def __columns(self, timerange, rsi_length, ema_length, price_action_length):
+        key = (timerange, rsi_length, ema_length, price_action_length)
+        entry = Screener.cache.get(key)
+        if entry is not None:
+            Screener.stats["hits"] += 1
+            return entry
+
+        Screener.stats["misses"] += 1
+        Screener.periods.setdefault(timerange, timerange_to_ms(timerange))
+        generation = Screener.generation
+        symbols, close = await self.__align(
+            timerange, max(rsi_length, ema_length, price_action_length)
+        )
+        columns = await self.executor.run(
+            calculations.screen, close, rsi_length, ema_length, price_action_length
+        )
+        entry = {"symbol": np.asarray(symbols, dtype=object), **columns}
+        if generation == Screener.generation:
+            Screener.cache[key] = entry
+
+        return entry
+
+    def __evaluate(self, node, columns):
+        """Evaluate a parsed filter expression on the columns - only a safe subset of Python."""
+        match node:
+            case ast.Expression():
+                return self.__evaluate(node.body, columns)
+            case ast.BoolOp(op=ast.And()):
+                result = self.__evaluate(node.values[0], columns)
+                for value in node.values[1:]:
+                    result = np.logical_and(result, self.__evaluate(value, columns))
+                return result
+            case ast.BoolOp(op=ast.Or()):
+                result = self.__evaluate(node.values[0], columns)
+                for value in node.values[1:]:
+                    result = np.logical_or(result, self.__evaluate(value, columns))
+                return result
+            case ast.UnaryOp(op=ast.Not()):
+                return np.logical_not(self.__evaluate(node.operand, columns))
+            case ast.UnaryOp(op=ast.USub()):
+                return -self.__evaluate(node.operand, columns)
+            case ast.BinOp(op=ast.Add() | ast.Sub() | ast.Mult() | ast.Div()):
+                left = self.__evaluate(node.left, columns)
+                right = self.__evaluate(node.right, columns)
+                match node.op:
+                    case ast.Add():
+                        return left + right
+                    case ast.Sub():
+                        return left - right
+                    case ast.Mult():
+                        return left * right
+                    case ast.Div():
+                        return left / right
+            case ast.Compare():
+                result = True
+                left = self.__evaluate(node.left, columns)
+                for op, comparator in zip(node.ops, node.comparators):
+                    right = self.__evaluate(comparator, columns)
+                    match op:
+                        case ast.Lt():
+                            result = result & (left < right)
+                        case ast.LtE():
+                            result = result & (left <= right)
+                        case ast.Gt():
+                            result = result & (left > right)
+                        case ast.GtE():
+                            result = result & (left >= right)
+                        case ast.Eq():
+                            result = result & (left == right)
+                        case ast.NotEq():
+                            result = result & (left != right)
+                        case _:
+                            raise ValueError("Unsupported comparison")
+                    left = right
+                return result
+            case ast.Name(id=name) if name in Screener.fields:
+                return columns[name]
+            case ast.Constant(value=value) if isinstance(
+                value, (int, float)
+            ) and not isinstance(value, bool):
+                return value
+
+        raise ValueError(f"Unsupported expression: {ast.unparse(node)}")
+
+    def __filter(self, expression, columns):
+        """Boolean mask of the rows matching an expression like "rsi<30 and ema_distance<2"."""
+        size = len(columns["symbol"])
+        if not expression:
+            return np.ones(size, dtype=bool)
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"Invalid filter: {e.msg}")
+
+        with np.errstate(invalid="ignore"):
+            mask = self.__evaluate(tree, columns)
+        if np.ndim(mask) == 0:
+            return np.full(size, bool(mask))
+
+        return np.asarray(mask, dtype=bool)
+
+    def __sort(self, expression, columns, rows):
+        """Order of the rows for an expression like "-price_action,rsi" (- descending)."""
+        keys = []
+        for field in str(expression or "").split(","):
+            field = field.strip()
+            if not field:
+                continue
+            descending = field.startswith("-")
+            field = field.lstrip("+-")
+            if field not in Screener.fields:
+                raise ValueError(f"Unknown sort field: {field}")
+            values = columns[field][rows]
+            keys.append(-values if descending else values)
+
+        if not keys:
+            return rows
+
+        # Last key is the primary one for lexsort - NaN sorts last
+        return rows[np.lexsort(keys[::-1])]
+
+    async def screen(
+        self,
+        timerange,
+        filter=None,
+        sort=None,
+        limit=None,
+        rsi_length=14,
+        ema_length=50,
+        price_action_length=24,
+    ):
+        """Symbols of the timerange with their indicators, filtered and sorted.
+
+        Raises ValueError for invalid filter or sort expressions.
+        """
+        columns = await self.__columns(
+            timerange, rsi_length, ema_length, price_action_length
+        )
+        rows = np.flatnonzero(self.__filter(filter, columns))
+        rows = self.__sort(sort, columns, rows)
+        if limit:
+            rows = rows[: int(limit)]
+
+        result = []
+        for row in rows:
+            item = {"symbol": columns["symbol"][row]}
+            for field in Screener.fields:
+                value = columns[field][row]
+                item[field] = None if np.isnan(value) else float(value)
+            result.append(item)
+
+        return {"timerange": timerange, "count": len(result), "result": result}
+
+    def get_stats(self):
+        return {**Screener.stats, "size": len(Screener.cache)}
@@ -0,0 +1,183 @@
+"""Encoders for responses made of column arrays.
+
+Every format is produced straight from the NumPy columns. orjson, msgpack
+and pyarrow are installed with requirements.txt, but stay optional -
+formats without their package installed are not offered (JSON falls back
+to the standard library).
+"""
+
+import json
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Format name: mimetype
+formats = {
+    # List of {"time", "open", ...} records
+    "json": "application/json",
+    # {"time": [...], "open": [...], ...}
+    "columns": "application/vnd.moonloader.columns+json",
+    "msgpack": "application/msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def available() -> list:
+    """Formats which can be produced with the installed packages."""
+    return [
+        name
+        for name, package in (
+            ("json", json),
+            ("columns", json),
+            ("msgpack", msgpack),
+            ("arrow", pyarrow),
+        )
+        if package is not None
+    ]
+
+
+def negotiate(format=None, accept=None) -> str:
+    """Pick the format from ?format= or the Accept header - json by default.
+
+    Raises ValueError if the requested format isn't available.
+    """
+    if format:
+        if format not in available():
+            raise ValueError(
+                f"Format {format} not available - use one of {', '.join(available())}"
+            )
+        return format
+
+    if accept is not None:
+        match = accept.best_match([formats[name] for name in available()])
+        if match is None and accept and "*/*" not in accept.values():
+            raise ValueError(
+                f"No acceptable format - use one of {', '.join(available())}"
+            )
+        for name in available():
+            if formats[name] == match:
+                return name
+
+    return "json"
+
+
+def _columns_json(columns) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(
+            {name: np.ascontiguousarray(values) for name, values in columns.items()},
+            option=orjson.OPT_SERIALIZE_NUMPY,
+        )
+    return json.dumps(
+        {name: np.asarray(values).tolist() for name, values in columns.items()}
+    ).encode()
+
+
+def _records_json(columns) -> bytes:
+    # pandas' to_json rounds to 10 decimals, which cuts the prices of low
+    # priced coins - orjson writes the exact values
+    names = list(columns)
+    records = [
+        dict(zip(names, row))
+        for row in zip(*(np.asarray(columns[name]).tolist() for name in names))
+    ]
+    if orjson is not None:
+        return orjson.dumps(records)
+    return json.dumps(records, separators=(",", ":")).encode()
+
+
+# msgpack type marker and big endian NumPy type of the array elements by dtype kind
+_msgpack_types = {
+    "f": (0xCB, ">f8"),
+    "i": (0xD3, ">i8"),
+    "u": (0xCF, ">u8"),
+}
+
+
+def _msgpack(columns) -> bytes:
+    """Pack the columns as a map of arrays.
+
+    Numeric elements are written from the NumPy buffers as fixed size
+    float 64 / int 64 instead of packing one Python object at a time.
+    """
+    packer = msgpack.Packer()
+    parts = [packer.pack_map_header(len(columns))]
+    for name, values in columns.items():
+        values = np.asarray(values)
+        parts.append(packer.pack(name))
+        if values.dtype.kind not in _msgpack_types:
+            parts.append(packer.pack(values.tolist()))
+            continue
+
+        marker, dtype = _msgpack_types[values.dtype.kind]
+        elements = np.empty(len(values), dtype=[("marker", "u1"), ("value", dtype)])
+        elements["marker"] = marker
+        elements["value"] = values
+        parts.append(packer.pack_array_header(len(values)))
+        parts.append(elements.tobytes())
+
+    return b"".join(parts)
+
+
+def _arrow(columns) -> bytes:
+    table = pyarrow.table(
+        {name: np.asarray(values) for name, values in columns.items()}
+    )
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def encode(columns, format="json") -> bytes:
+    """Encode a dict of equally long column arrays in the given format."""
+    match format:
+        case "json":
+            return _records_json(columns)
+        case "columns":
+            return _columns_json(columns)
+        case "msgpack":
+            return _msgpack(columns)
+        case "arrow":
+            return _arrow(columns)
+
+    raise ValueError(f"Unknown format {format}")
+
+
+def stream(chunks, format="json"):
+    """Encode an async iterator of column chunks piece by piece.
+
+    json is written as one list of records, msgpack as one map per chunk.
+    Raises ValueError for formats which can't be streamed.
+    """
+    if format not in ("json", "msgpack"):
+        raise ValueError(f"Format {format} can't be streamed - use json or msgpack")
+
+    async def encoded():
+        if format == "msgpack":
+            async for chunk in chunks:
+                yield encode(chunk, format)
+            return
+
+        separator = b"["
+        async for chunk in chunks:
+            records = encode(chunk, format)[1:-1]
+            if records:
+                yield separator + records
+                separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+
+    return encoded()
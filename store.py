@@ -0,0 +1,524 @@
+import asyncio
+import numpy as np
+import os
+import shutil
+import time
+
+from candles import timerange_to_ms
+from metrics import Metrics
+from models import Tickers
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+# Candle columns and their on-disk types
+columns = (
+    ("timestamp", np.int64),
+    ("open", np.float64),
+    ("high", np.float64),
+    ("low", np.float64),
+    ("close", np.float64),
+    ("volume", np.float64),
+)
+
+
+class TableStore:
+    """Candles as rows of the Tickers table."""
+
+    async def setup(self):
+        pass
+
+    async def write(self, tickers):
+        async with in_transaction("default") as connection:
+            await Tickers.bulk_create(tickers, using_db=connection)
+
+    def __to_columns(self, rows) -> dict:
+        data = list(zip(*rows)) if rows else [[] for _ in columns]
+        return {
+            name: np.asarray(values, dtype=dtype)
+            for (name, dtype), values in zip(columns, data)
+        }
+
+    async def read(self, pair, start=None, end=None, limit=None) -> dict:
+        """The first limit candles of the pair with start < timestamp < end (in ms)."""
+        query = Tickers.filter(symbol=pair)
+        if start is not None:
+            query = query.filter(timestamp__gt=int(start))
+        if end is not None:
+            query = query.filter(timestamp__lt=int(end))
+        if limit is not None:
+            query = query.limit(int(limit))
+        rows = await query.order_by("timestamp").values_list(
+            *[name for name, dtype in columns]
+        )
+
+        return self.__to_columns(rows)
+
+    async def recent(self, pair, limit) -> dict:
+        """The last limit candles of the pair."""
+        rows = (
+            await Tickers.filter(symbol=pair)
+            .order_by("-timestamp")
+            .limit(limit)
+            .values_list(*[name for name, dtype in columns])
+        )
+        rows.reverse()
+
+        return self.__to_columns(rows)
+
+    async def last_timestamp(self, pair):
+        timestamp = (
+            await Tickers.filter(symbol=pair)
+            .order_by("-timestamp")
+            .first()
+            .values_list("timestamp", flat=True)
+        )
+        return int(timestamp) if timestamp is not None else None
+
+    async def delete(self, pair) -> int:
+        return await Tickers.filter(symbol=pair).delete()
+
+    async def read_resampled(self, pair, timerange):
+        """Resampled candles of the pair if the storage keeps them - None otherwise."""
+        return None
+
+    async def cleanup(self, before, pair=None, exclude=(), chunk_size=5000) -> int:
+        """Delete in chunks of chunk_size rows, so live writes get their turn in between."""
+        query = Tickers.filter(timestamp__lt=int(before))
+        if pair is not None:
+            query = query.filter(symbol=pair)
+        if exclude:
+            query = query.exclude(symbol__in=list(exclude))
+
+        deleted = 0
+        while True:
+            ids = await query.limit(int(chunk_size)).values_list("id", flat=True)
+            if not ids:
+                break
+            deleted += await Tickers.filter(id__in=ids).delete()
+            await asyncio.sleep(0)
+
+        return deleted
+
+
+class PostgresStore(TableStore):
+    """Tickers table in PostgreSQL, optionally a TimescaleDB hypertable.
+
+    Candles are written with COPY. With Timescale the table is partitioned
+    by timestamp and every rollup timerange gets a real-time continuous
+    aggregate, which the rollups read instead of resampling the history.
+    """
+
+    # Hypertable chunks of one week in ms
+    chunk_interval = 7 * 24 * 60 * 60 * 1000
+
+    def __init__(self, timescale=False, timeranges=()):
+        self.timescale = timescale
+        # Continuous aggregate view per timerange in ms
+        self.aggregates = {
+            timerange_to_ms(timerange): "tickers_"
+            + "".join(char for char in timerange if char.isalnum())
+            for timerange in timeranges
+        }
+
+    async def setup(self):
+        if not self.timescale:
+            return
+
+        connection = Tortoise.get_connection("default")
+        await connection.execute_script("CREATE EXTENSION IF NOT EXISTS timescaledb")
+        _, rows = await connection.execute_query(
+            "SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = 'tickers'"
+        )
+        if not rows:
+            # The primary key of a hypertable has to contain the partitioning column
+            await connection.execute_script(f"""
+                ALTER TABLE "tickers" DROP CONSTRAINT IF EXISTS "tickers_pkey";
+                ALTER TABLE "tickers" ADD PRIMARY KEY ("id", "timestamp");
+                SELECT create_hypertable('tickers', 'timestamp',
+                    chunk_time_interval => {PostgresStore.chunk_interval}::BIGINT,
+                    migrate_data => true);
+                CREATE OR REPLACE FUNCTION unix_now_ms() RETURNS BIGINT
+                    LANGUAGE SQL STABLE AS $$ SELECT (extract(epoch FROM now()) * 1000)::BIGINT $$;
+                SELECT set_integer_now_func('tickers', 'unix_now_ms');
+                """)
+
+        for timerange_ms, view in self.aggregates.items():
+            await connection.execute_script(f"""
+                CREATE MATERIALIZED VIEW IF NOT EXISTS "{view}"
+                WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+                SELECT "symbol", time_bucket({timerange_ms}::BIGINT, "timestamp") AS "bucket",
+                    first("open", "timestamp") AS "open", max("high") AS "high",
+                    min("low") AS "low", last("close", "timestamp") AS "close",
+                    sum("volume") AS "volume"
+                FROM "tickers" GROUP BY "symbol", "bucket" WITH NO DATA;
+                SELECT add_continuous_aggregate_policy('{view}',
+                    start_offset => NULL, end_offset => {timerange_ms}::BIGINT,
+                    schedule_interval => INTERVAL '{max(timerange_ms // 1000, 60)} seconds',
+                    if_not_exists => true);
+                """)
+
+    async def write(self, tickers):
+        connection = Tortoise.get_connection("default")
+        async with connection.acquire_connection() as connection:
+            await connection.copy_records_to_table(
+                "tickers",
+                records=[
+                    (
+                        int(ticker.timestamp),
+                        ticker.symbol,
+                        float(ticker.open),
+                        float(ticker.high),
+                        float(ticker.low),
+                        float(ticker.close),
+                        float(ticker.volume),
+                    )
+                    for ticker in tickers
+                ],
+                columns=[
+                    "timestamp",
+                    "symbol",
+                    "open",
+                    "high",
+                    "low",
+                    "close",
+                    "volume",
+                ],
+            )
+
+    async def read_resampled(self, pair, timerange):
+        view = self.aggregates.get(timerange_to_ms(timerange))
+        if not self.timescale or view is None:
+            return None
+
+        connection = Tortoise.get_connection("default")
+        _, rows = await connection.execute_query(
+            f'SELECT "bucket", "open", "high", "low", "close", "volume" FROM "{view}" '
+            'WHERE "symbol" = $1 ORDER BY "bucket"',
+            [pair],
+        )
+        data = list(zip(*rows)) if rows else [[] for _ in columns]
+        return {
+            name: np.asarray(values, dtype=dtype)
+            for (name, dtype), values in zip(columns, data)
+        }
+
+
+class ColumnarStore:
+    """Candles as memory-mapped column files per symbol.
+
+    Every symbol has a directory with a generation of column files, one
+    file per column sorted by timestamp, and a current file naming the
+    generation and its number of committed rows. Reads are binary searches
+    on the timestamps and return read-only views of the committed rows of
+    the mapped files - no rows get materialized.
+
+    Newer candles are appended behind the committed rows, which get counted
+    in only once all columns are written. Older or duplicated ones are
+    merged into a new generation which replaces the current one, so views
+    handed out before never change and a crash never leaves the columns of
+    the committed rows misaligned. The file work runs in a thread, one
+    write at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Mapped columns per pair with the (generation, rows) they were mapped at
+        self.maps = {}
+        self.lock = asyncio.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def __file(self, pair, generation, name):
+        return os.path.join(self.path, pair, generation, f"{name}.bin")
+
+    def __current(self, pair):
+        """Generation and committed rows of the pair."""
+        try:
+            with open(os.path.join(self.path, pair, "current")) as file:
+                generation, rows = file.read().split()
+            return generation, int(rows)
+        except FileNotFoundError:
+            pass
+
+        # Files written before the generations - a torn write leaves longer columns
+        sizes = []
+        for name, dtype in columns:
+            try:
+                size = os.path.getsize(self.__file(pair, ".", name))
+            except FileNotFoundError:
+                size = 0
+            sizes.append(size // np.dtype(dtype).itemsize)
+
+        return ".", min(sizes)
+
+    def __commit(self, pair, generation, rows):
+        path = os.path.join(self.path, pair, "current")
+        with open(f"{path}.tmp", "w") as file:
+            file.write(f"{generation} {rows}")
+        os.replace(f"{path}.tmp", path)
+
+    def __columns(self, pair) -> dict:
+        current = self.__current(pair)
+        mapped = self.maps.get(pair)
+        if mapped is not None and mapped[0] == current:
+            return mapped[1]
+
+        generation, rows = current
+        if rows:
+            data = {
+                name: np.memmap(
+                    self.__file(pair, generation, name),
+                    dtype=dtype,
+                    mode="r",
+                    shape=(rows,),
+                )
+                for name, dtype in columns
+            }
+        else:
+            data = {name: np.empty(0, dtype=dtype) for name, dtype in columns}
+        self.maps[pair] = (current, data)
+
+        return data
+
+    def __merge(self, *parts) -> dict:
+        """Concatenate the column parts, sort by timestamp and drop duplicates (last wins)."""
+        data = {
+            name: np.concatenate([part[name] for part in parts]).astype(dtype)
+            for name, dtype in columns
+        }
+        order = np.argsort(data["timestamp"], kind="stable")
+        timestamps = data["timestamp"][order]
+        keep = np.append(timestamps[1:] != timestamps[:-1], True)
+
+        return {name: values[order][keep] for name, values in data.items()}
+
+    def __append(self, pair, generation, rows, data):
+        """Write data behind the committed rows and commit them."""
+        os.makedirs(os.path.join(self.path, pair, generation), exist_ok=True)
+        for name, dtype in columns:
+            path = self.__file(pair, generation, name)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+                # Overwrites the rest of a torn write
+                file.seek(rows * np.dtype(dtype).itemsize)
+                file.write(np.ascontiguousarray(data[name], dtype=dtype).tobytes())
+        self.__commit(pair, generation, rows + len(data["timestamp"]))
+
+    def __replace(self, pair, head, data):
+        """Write the first head committed rows plus data as a new generation."""
+        generation, rows = self.__current(pair)
+        replacement = str(time.time_ns())
+        os.makedirs(os.path.join(self.path, pair, replacement))
+        for name, dtype in columns:
+            size = head * np.dtype(dtype).itemsize
+            with open(self.__file(pair, replacement, name), "wb") as file:
+                if size:
+                    with open(self.__file(pair, generation, name), "rb") as source:
+                        # Copied by the kernel - a reflink where the filesystem has them
+                        copied = 0
+                        while copied < size:
+                            count = os.copy_file_range(
+                                source.fileno(), file.fileno(), size - copied
+                            )
+                            if not count:
+                                raise OSError(f"{pair} {name} is shorter than its rows")
+                            copied += count
+                file.write(np.ascontiguousarray(data[name], dtype=dtype).tobytes())
+        self.__commit(pair, replacement, head + len(data["timestamp"]))
+
+        # Mapped views of the old files stay valid after they are unlinked.
+        # Generations left behind by a crash get removed as well.
+        for entry in os.scandir(os.path.join(self.path, pair)):
+            if entry.is_dir() and entry.name != replacement:
+                shutil.rmtree(entry.path, True)
+            elif entry.name.endswith(".bin"):
+                os.remove(entry.path)
+
+    def __write_pair(self, pair, data):
+        os.makedirs(os.path.join(self.path, pair), exist_ok=True)
+        generation, rows = self.__current(pair)
+        timestamps = self.__columns(pair)["timestamp"]
+        if not rows or data["timestamp"][0] > timestamps[-1]:
+            self.__append(pair, generation, rows, data)
+            return
+
+        # Out of order (e.g. backfill) - the rows from the insertion point are merged
+        position = int(np.searchsorted(timestamps, data["timestamp"][0], "left"))
+        existing = self.__columns(pair)
+        tail = {name: existing[name][position:] for name, dtype in columns}
+        self.__replace(pair, position, self.__merge(tail, data))
+
+    def __write(self, pairs):
+        for pair, rows in pairs.items():
+            data = np.asarray(rows, dtype=np.float64)
+            self.__write_pair(
+                pair,
+                self.__merge(
+                    {
+                        name: data[:, index]
+                        for index, (name, dtype) in enumerate(columns)
+                    }
+                ),
+            )
+
+    async def write(self, tickers):
+        pairs = {}
+        for ticker in tickers:
+            pairs.setdefault(ticker.symbol, []).append(
+                [getattr(ticker, name) for name, dtype in columns]
+            )
+
+        async with self.lock:
+            await asyncio.to_thread(self.__write, pairs)
+
+    async def read(self, pair, start=None, end=None, limit=None) -> dict:
+        """The first limit candles of the pair with start < timestamp < end (in ms) as views."""
+        data = self.__columns(pair)
+        timestamps = data["timestamp"]
+        first = 0
+        last = len(timestamps)
+        if start is not None:
+            first = int(np.searchsorted(timestamps, int(start), "right"))
+        if end is not None:
+            last = int(np.searchsorted(timestamps, int(end), "left"))
+        if limit is not None:
+            last = min(last, first + int(limit))
+
+        return {name: values[first:last] for name, values in data.items()}
+
+    async def recent(self, pair, limit) -> dict:
+        """The last limit candles of the pair as views."""
+        data = self.__columns(pair)
+        return {name: values[-int(limit) :] for name, values in data.items()}
+
+    async def last_timestamp(self, pair):
+        timestamps = self.__columns(pair)["timestamp"]
+        return int(timestamps[-1]) if len(timestamps) else None
+
+    def __delete(self, pair) -> int:
+        generation, rows = self.__current(pair)
+        self.maps.pop(pair, None)
+        shutil.rmtree(os.path.join(self.path, pair), ignore_errors=True)
+
+        return rows
+
+    async def delete(self, pair) -> int:
+        async with self.lock:
+            return await asyncio.to_thread(self.__delete, pair)
+
+    async def setup(self):
+        pass
+
+    async def read_resampled(self, pair, timerange):
+        return None
+
+    def __cleanup(self, pair, before) -> int:
+        data = self.__columns(pair)
+        position = int(np.searchsorted(data["timestamp"], int(before), "left"))
+        if position:
+            self.__replace(
+                pair, 0, {name: values[position:] for name, values in data.items()}
+            )
+
+        return position
+
+    async def cleanup(self, before, pair=None, exclude=(), chunk_size=None) -> int:
+        # Every pair is rewritten once - chunking doesn't apply to the files
+        deleted = 0
+        pairs = [pair] if pair is not None else os.listdir(self.path)
+        for pair in pairs:
+            if pair in exclude:
+                continue
+            async with self.lock:
+                deleted += await asyncio.to_thread(self.__cleanup, pair, before)
+
+        return deleted
+
+
+class Store:
+    """Candle storage - selects the configured backend for every instance.
+
+    database keeps the candles in the Tickers table of the configured
+    database (SQLite or PostgreSQL), columnar in memory-mapped column files
+    (see ColumnarStore). All reads return the columns as NumPy arrays sorted
+    by timestamp.
+    """
+
+    kind = "database"
+    backend = None
+    # Incremented with every change of the stored candles per pair
+    revisions = {}
+
+    def __init__(
+        self,
+        kind=None,
+        path="db/candles",
+        database="sqlite",
+        timescale=False,
+        timeranges=(),
+    ):
+        self.metrics = Metrics()
+        if kind not in (None, "database", "columnar"):
+            raise ValueError(f"Unknown candle store {kind}")
+        if kind:
+            Store.kind = kind
+        if kind or Store.backend is None:
+            if Store.kind == "columnar":
+                Store.backend = ColumnarStore(path)
+            elif database == "postgres":
+                Store.backend = PostgresStore(timescale, timeranges)
+            else:
+                Store.backend = TableStore()
+
+    async def setup(self):
+        """Create the storage specific objects after the schema got generated."""
+        await Store.backend.setup()
+
+    async def write(self, tickers):
+        """Write a list of Tickers objects."""
+        with self.metrics.time("moonloader_db_seconds", operation="write"):
+            await Store.backend.write(tickers)
+        self.__changed({ticker.symbol for ticker in tickers})
+
+    def __changed(self, pairs):
+        for pair in pairs:
+            Store.revisions[pair] = Store.revisions.get(pair, 0) + 1
+
+    async def read(self, pair, start=None, end=None, limit=None) -> dict:
+        with self.metrics.time("moonloader_db_seconds", "fetch", operation="read"):
+            return await Store.backend.read(pair, start, end, limit)
+
+    async def recent(self, pair, limit) -> dict:
+        with self.metrics.time("moonloader_db_seconds", "fetch", operation="recent"):
+            return await Store.backend.recent(pair, limit)
+
+    async def read_resampled(self, pair, timerange):
+        """Resampled candles (bucket start in ms) kept by the storage or None."""
+        with self.metrics.time(
+            "moonloader_db_seconds", "fetch", operation="read_resampled"
+        ):
+            return await Store.backend.read_resampled(pair, timerange)
+
+    async def last_timestamp(self, pair):
+        with self.metrics.time(
+            "moonloader_db_seconds", "fetch", operation="last_timestamp"
+        ):
+            return await Store.backend.last_timestamp(pair)
+
+    async def delete(self, pair) -> int:
+        with self.metrics.time("moonloader_db_seconds", operation="delete"):
+            deleted = await Store.backend.delete(pair)
+        self.__changed([pair])
+
+        return deleted
+
+    async def cleanup(self, before, pair=None, exclude=(), chunk_size=5000) -> int:
+        """Delete the candles older than before (in ms) of one pair or all but the excluded ones."""
+        with self.metrics.time("moonloader_db_seconds", operation="cleanup"):
+            deleted = await Store.backend.cleanup(before, pair, exclude, chunk_size)
+        if deleted:
+            self.__changed(
+                [pair]
+                if pair is not None
+                else [key for key in Store.revisions if key not in exclude]
+            )
+
+        return deleted
@@ -0,0 +1,174 @@
+import asyncio
+import time
+
+from logger import LoggerFactory
+from store import Store
+from tenacity import retry, stop_after_attempt, wait_fixed
+
+
+class Writer:
+    """Writes closed candles in batches, decoupled from the websocket loop.
+
+    Candles are queued by the ingestion and flushed by a background task once
+    the batch size is reached or the flush interval passed - whatever comes
+    first. Every batch is written to the candle store in one go. A batch
+    which still fails after the retries is kept and written again before
+    any newer candle, with a growing delay - meanwhile the queue buffers
+    the new candles. Batches are collected and written under a lock, so
+    discard can drop the candles of a symbol before it gets deleted.
+    """
+
+    max_backoff = 60
+
+    def __init__(self, loglevel, batch_size=500, flush_interval=1, queue_size=100000):
+        self.batch_size = int(batch_size)
+        self.flush_interval = float(flush_interval)
+        self.store = Store()
+
+        # Class variables
+        Writer.status = True
+        Writer.queue = asyncio.Queue(maxsize=int(queue_size))
+        Writer.lock = asyncio.Lock()
+        # Batch whose write failed and the delay before writing it again
+        Writer.pending = None
+        Writer.backoff = 0
+        Writer.stats = {
+            "flushes": 0,
+            "rows": 0,
+            "errors": 0,
+            # Candles not queued because the queue was full
+            "dropped": 0,
+            # Candles not written because the writer stopped with a failed batch
+            "lost": 0,
+            "last_flush_latency": 0.0,
+            "max_flush_latency": 0.0,
+        }
+        Writer.logging = LoggerFactory.get_logger(
+            "logs/writer.log", "writer", log_level=loglevel
+        )
+        Writer.logging.info("Initialized")
+
+    def enqueue(self, ticker):
+        """Queue a Tickers object for the next flush."""
+        try:
+            Writer.queue.put_nowait(ticker)
+        except asyncio.QueueFull:
+            Writer.stats["dropped"] += 1
+            Writer.logging.error(
+                f"Write queue full - dropping candle {ticker.symbol}@{ticker.timestamp}"
+            )
+
+    async def discard(self, symbols) -> int:
+        """Drop the queued and pending candles of the symbols.
+
+        Waits for a batch which is collected or written at the moment.
+        Returns the number of dropped candles.
+        """
+        symbols = set(symbols)
+        dropped = 0
+        async with Writer.lock:
+            if Writer.pending is not None:
+                pending = [
+                    ticker for ticker in Writer.pending if ticker.symbol not in symbols
+                ]
+                dropped += len(Writer.pending) - len(pending)
+                Writer.pending = pending or None
+
+            queued = []
+            while not Writer.queue.empty():
+                queued.append(Writer.queue.get_nowait())
+            for ticker in queued:
+                if ticker.symbol in symbols:
+                    dropped += 1
+                else:
+                    Writer.queue.put_nowait(ticker)
+
+        return dropped
+
+    def get_stats(self):
+        return {
+            **Writer.stats,
+            "queue_depth": Writer.queue.qsize(),
+            "pending": len(Writer.pending or ()),
+        }
+
+    @retry(wait=wait_fixed(1), stop=stop_after_attempt(5), reraise=True)
+    async def __write(self, batch):
+        await self.store.write(batch)
+
+    async def __flush(self, batch) -> bool:
+        start_time = time.perf_counter()
+        try:
+            await self.__write(batch)
+        except Exception as e:
+            Writer.stats["errors"] += 1
+            Writer.pending = batch
+            Writer.backoff = min(max(Writer.backoff * 2, 1), Writer.max_backoff)
+            Writer.logging.error(
+                f"Error writing {len(batch)} candles into db - retrying in {Writer.backoff}s. Cause: {e}"
+            )
+            return False
+
+        Writer.pending = None
+        Writer.backoff = 0
+
+        latency = time.perf_counter() - start_time
+        Writer.stats["flushes"] += 1
+        Writer.stats["rows"] += len(batch)
+        Writer.stats["last_flush_latency"] = latency
+        Writer.stats["max_flush_latency"] = max(
+            Writer.stats["max_flush_latency"], latency
+        )
+        Writer.logging.debug(
+            f"Flushed {len(batch)} candles in {latency:.3f}s. Queue depth: {Writer.queue.qsize()}"
+        )
+
+        return True
+
+    async def run(self):
+        while Writer.status:
+            if Writer.pending is not None:
+                # The failed batch goes first, so the candles stay in order
+                await asyncio.sleep(Writer.backoff)
+                if not Writer.status:
+                    # Written by shutdown
+                    break
+                async with Writer.lock:
+                    batch, Writer.pending = Writer.pending, None
+                    if batch is not None:
+                        await self.__flush(batch)
+                continue
+
+            async with Writer.lock:
+                batch = await self.__collect()
+                if batch:
+                    await self.__flush(batch)
+
+    async def __collect(self) -> list:
+        """Collect until the batch is full or the flush interval passed."""
+        loop = asyncio.get_running_loop()
+        try:
+            batch = [await asyncio.wait_for(Writer.queue.get(), self.flush_interval)]
+        except asyncio.TimeoutError:
+            return []
+
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(Writer.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def shutdown(self):
+        Writer.status = False
+        batch = list(Writer.pending or ())
+        while not Writer.queue.empty():
+            batch.append(Writer.queue.get_nowait())
+        if batch and not await self.__flush(batch):
+            Writer.stats["lost"] += len(batch)
+            Writer.logging.error(f"Lost {len(batch)} candles on shutdown")